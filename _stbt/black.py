@@ -12,7 +12,7 @@ import cv2
 
 from .config import get_config
 from .imgutils import (_frame_repr, _image_region, _ImageFromUser, _load_image,
-                       pixel_bounding_box, crop)
+                       _low_res_gray, _resize_mask, pixel_bounding_box)
 from .logging import debug, ImageLogger
 from .types import Region
 
@@ -76,10 +76,11 @@ def is_screen_black(frame=None, mask=None, threshold=None, region=Region.ALL):
     imglog.imwrite("source", frame)
 
     _region = Region.intersect(_image_region(frame), region)
-    greyframe = cv2.cvtColor(crop(frame, _region), cv2.COLOR_BGR2GRAY)
+    greyframe, grey_region, _ = _low_res_gray(frame, _region)
     if mask.image is not None:
         imglog.imwrite("mask", mask.image)
-        cv2.bitwise_and(greyframe, mask.image, dst=greyframe)
+        greyframe = cv2.bitwise_and(
+            greyframe, _resize_mask(mask.image, _region, grey_region))
     maxVal = greyframe.max()
 
     result = _IsScreenBlackResult(bool(maxVal <= threshold), frame)
@@ -19,7 +19,7 @@ import threading
 import traceback
 import warnings
 import weakref
-from collections import deque, namedtuple
+from collections import deque, namedtuple, OrderedDict
 from contextlib import contextmanager
 
 import cv2
@@ -27,9 +27,9 @@ import gi
 
 import _stbt.cv2_compat as cv2_compat
 from _stbt import logging
-from _stbt.config import get_config
+from _stbt.config import ConfigurationError, get_config
 from _stbt.gst_utils import (array_from_sample, gst_iterate,
-                             gst_sample_make_writable)
+                             gst_sample_make_writable, overlay_composition)
 from _stbt.imgutils import _frame_repr, find_user_file, Frame, imread
 from _stbt.logging import ddebug, debug, warn
 from _stbt.types import Region, UITestError, UITestFailure
@@ -111,6 +111,19 @@ def new_device_under_test_from_config(parsed_args=None):
         args.restart_source = get_config('global', 'restart_source', type_=bool)
     source_teardown_eos = get_config('global', 'source_teardown_eos',
                                      type_=bool)
+    frame_buffer_depth = get_config('global', 'frame_buffer_depth', type_=int)
+    frame_buffer_max_bytes = int(
+        get_config('global', 'frame_buffer_max_mb', type_=float) * 1024 * 1024)
+    sink_buffer_max_bytes = int(
+        get_config('global', 'sink_buffer_max_mb', type_=float) * 1024 * 1024)
+    gray_stream_scale = get_config('global', 'gray_stream_scale', type_=float)
+    videoconvert_threads = get_config('global', 'videoconvert_threads',
+                                      type_=int)
+    decoder_threads = get_config('global', 'decoder_threads', type_=int)
+    for name, value in [('videoconvert_threads', videoconvert_threads),
+                        ('decoder_threads', decoder_threads)]:
+        if value < 0:
+            raise ConfigurationError("'global.%s' must be >= 0" % name)
 
     display = [None]
 
@@ -122,11 +135,13 @@ def new_device_under_test_from_config(parsed_args=None):
         sink_pipeline = NoSinkPipeline()
     else:
         sink_pipeline = SinkPipeline(  # pylint: disable=redefined-variable-type
-            args.sink_pipeline, raise_in_user_thread, args.save_video)
+            args.sink_pipeline, raise_in_user_thread, args.save_video,
+            sink_buffer_max_bytes)
 
     display[0] = Display(
         args.source_pipeline, sink_pipeline, args.restart_source,
-        source_teardown_eos)
+        source_teardown_eos, frame_buffer_depth, frame_buffer_max_bytes,
+        gray_stream_scale, videoconvert_threads, decoder_threads)
     return DeviceUnderTest(
         display=display[0], control=uri_to_control(args.control, display[0]),
         sink_pipeline=sink_pipeline, mainloop=mainloop)
@@ -144,6 +159,7 @@ class DeviceUnderTest(object):
         self._mainloop = mainloop
         self._time = _time
         self._last_keypress = None
+        self.frames_dropped = 0
 
     def __enter__(self):
         if self._display:
@@ -155,6 +171,11 @@ class DeviceUnderTest(object):
     def __exit__(self, exc_type, exc_value, tb):
         if self._display:
             self._sink_pipeline.exit_prep()
+            if self.frames_dropped:
+                debug("teardown: `frames` dropped %d frames in total because "
+                      "the test script didn't keep up with the video "
+                      "(see frame_buffer_depth in stbt.conf)"
+                      % self.frames_dropped)
             self._display.__exit__(exc_type, exc_value, tb)
             self._display = None
             self._sink_pipeline.__exit__(exc_type, exc_value, tb)
@@ -269,19 +290,59 @@ class DeviceUnderTest(object):
         timestamp = None
         first = True
 
-        while True:
-            ddebug("user thread: Getting sample at %s" % self._time.time())
-            frame = self._display.get_frame(
-                max(10, timeout_secs), since=timestamp)
-            ddebug("user thread: Got sample at %s" % self._time.time())
-            timestamp = frame.time
-
-            if not first and timeout_secs is not None and timestamp > end_time:
-                debug("timed out: %.3f > %.3f" % (timestamp, end_time))
-                return
+        min_interval = _min_analysis_interval()
+        yield_time = None
+        sequence_number = None
+        frames_processed = 0
+        frames_dropped = 0
+        processing_secs = 0.
 
-            yield frame
-            first = False
+        try:
+            while True:
+                if not first:
+                    # The time that our caller spent processing the previous
+                    # frame:
+                    elapsed = self._time.time() - yield_time
+                    processing_secs += elapsed
+                    if elapsed < min_interval:
+                        self._time.sleep(min_interval - elapsed)
+
+                ddebug("user thread: Getting sample at %s" % self._time.time())
+                frame = self._display.get_frame(
+                    max(10, timeout_secs), since=timestamp)
+                ddebug("user thread: Got sample at %s" % self._time.time())
+                timestamp = frame.time
+
+                if (not first and timeout_secs is not None and
+                        timestamp > end_time):
+                    debug("timed out: %.3f > %.3f" % (timestamp, end_time))
+                    return
+
+                # We get the oldest frame newer than `timestamp` that the
+                # display still has in its buffer (see `frame_buffer_depth`).
+                # If our caller is slower than the video's frame rate and the
+                # buffer overflows, the frames that fell out of the buffer are
+                # dropped. With the default buffer of 1 frame that means we
+                # always get the most recent frame, which keeps the latency
+                # low (the caller doesn't fall further & further behind the
+                # video).
+                n = getattr(frame, "_sequence_number", None)
+                if sequence_number is not None and n is not None:
+                    frames_dropped += n - sequence_number - 1
+                sequence_number = n
+                frames_processed += 1
+
+                yield_time = self._time.time()
+                yield frame
+                first = False
+        finally:
+            self.frames_dropped += frames_dropped
+            if frames_processed > 1:
+                debug("frames: Processed %d frames in %.3fs per frame; "
+                      "dropped %d frames" % (
+                          frames_processed,
+                          processing_secs / (frames_processed - 1),
+                          frames_dropped))
 
     def get_frame(self):
         return self._display.get_frame()
@@ -333,6 +394,9 @@ def wait_until(callable_, timeout_secs=10, interval_secs=0, predicate=None,
 
     :type interval_secs: int or float, in seconds
     :param interval_secs: Delay between successive invocations of ``callable_``.
+        If ``max_analysis_fps`` is set in the ``[global]`` section of
+        :ref:`.stbt.conf`, successive invocations will also be at least
+        ``1 / max_analysis_fps`` seconds apart.
 
     :param predicate: A function that takes a single value. It will be given
         the return value from ``callable_``. The return value of *this* function
@@ -412,6 +476,8 @@ def wait_until(callable_, timeout_secs=10, interval_secs=0, predicate=None,
     stable_predicate_value = None
     expiry_time = time.time() + timeout_secs
 
+    min_interval = _min_analysis_interval()
+
     while True:
         t = time.time()
         value = callable_()
@@ -440,7 +506,19 @@ def wait_until(callable_, timeout_secs=10, interval_secs=0, predicate=None,
             else:
                 return None  # must have failed stable_secs or predicate checks
 
-        time.sleep(interval_secs)
+        time.sleep(max(interval_secs, min_interval - (time.time() - t)))
+
+
+def _min_analysis_interval():
+    """The minimum time (in seconds) between the frames that `frames` gives to
+    the test script, and between the calls that `wait_until` makes, according
+    to ``max_analysis_fps`` in the ``[global]`` section of :ref:`.stbt.conf`.
+    """
+    max_fps = get_config("global", "max_analysis_fps", type_=float)
+    if max_fps > 0:
+        return 1. / max_fps
+    else:
+        return 0.
 
 
 def _callable_description(callable_):
@@ -611,17 +689,51 @@ class _Annotation(namedtuple("_Annotation", "time region label colour")):
         colour = _Annotation.MATCHED if result else _Annotation.NO_MATCH
         return _Annotation(result.time, result.region, label, colour)
 
-    def draw(self, img):
+    @property
+    def _label(self):
+        # Slightly above the match annotation
+        return _TextLabel(self.label, (self.region.x, self.region.y - 10),
+                          (255, 255, 255), font_scale=0.5)
+
+    @property
+    def bounding_box(self):
+        """The region of the video that `draw` modifies."""
+        if not self.region:
+            return None
+        return Region.bounding_box(self.region.dilate(3),
+                                   self._label.bounding_box)
+
+    def draw(self, img, offset=(0, 0)):
         if not self.region:
             return
+        region = self.region.translate(*offset)
         cv2.rectangle(
-            img, (self.region.x, self.region.y),
-            (self.region.right, self.region.bottom), self.colour,
-            thickness=3)
+            img, (region.x, region.y), (region.right, region.bottom),
+            self.colour, thickness=3)
+        self._label.draw(img, offset)
 
-        # Slightly above the match annotation
-        label_loc = (self.region.x, self.region.y - 10)
-        _draw_text(img, self.label, label_loc, (255, 255, 255), font_scale=0.5)
+
+class _TextLabel(namedtuple("_TextLabel", "text origin colour font_scale")):
+    def __new__(cls, text, origin, colour, font_scale=1.0):
+        return super(_TextLabel, cls).__new__(
+            cls, text, origin, colour, font_scale)
+
+    @property
+    def bounding_box(self):
+        """The region of the video that `draw` modifies."""
+        if not self.text:
+            return None
+        (width, height), baseline = cv2.getTextSize(
+            self.text, fontFace=cv2.FONT_HERSHEY_DUPLEX,
+            fontScale=self.font_scale, thickness=1)
+        x, y = self.origin
+        return Region.from_extents(x - 2, y - height - 2, x + width + 3,
+                                   y + max(baseline, 2) + 1)
+
+    def draw(self, img, offset=(0, 0)):
+        _draw_text(img, self.text,
+                   (self.origin[0] + offset[0], self.origin[1] + offset[1]),
+                   self.colour, self.font_scale)
 
 
 class _TextAnnotation(namedtuple("_TextAnnotation", "time text duration")):
@@ -631,7 +743,8 @@ class _TextAnnotation(namedtuple("_TextAnnotation", "time text duration")):
 
 
 class SinkPipeline(object):
-    def __init__(self, user_sink_pipeline, raise_in_user_thread, save_video=""):
+    def __init__(self, user_sink_pipeline, raise_in_user_thread, save_video="",
+                 max_buffered_bytes=210 * 1024 * 1024):
         import time as _time
 
         self.annotations_lock = threading.Lock()
@@ -639,10 +752,25 @@ class SinkPipeline(object):
         self.annotations = []
         self._raise_in_user_thread = raise_in_user_thread
         self.received_eos = threading.Event()
-        self._frames = deque(maxlen=35)
+        self._frames = deque()
+        self._frames_nbytes = 0
+        self._max_buffered_bytes = max_buffered_bytes
         self._time = _time
         self._sample_count = 0
 
+        # If we can, we leave the video-frames untouched (they're shared with
+        # the test script, so drawing on them would mean copying the whole
+        # frame) and draw the annotations after `videoconvert`, which creates
+        # new buffers anyway, with `overlaycomposition` (GStreamer 1.20+).
+        # `_overlays` maps buffer timestamps to the `GstVideoOverlayComposition`
+        # to draw on that frame.
+        self._overlays = None
+        overlay = ""
+        if _overlaycomposition_available():
+            self._overlays = OrderedDict()
+            self._overlays_lock = threading.Lock()
+            overlay = "overlaycomposition ! "
+
         # The test script can draw on the video, but this happens in a different
         # thread.  We don't know when they're finished drawing so we just give
         # them 0.5s instead.
@@ -663,15 +791,16 @@ class SinkPipeline(object):
                 save_video += ".webm"
             debug("Saving video to '%s'" % save_video)
             sink_pipeline_description += (
-                "{src} ! videoconvert ! "
+                "{src} ! videoconvert ! {overlay}"
                 "vp8enc cpu-used=6 min_quantizer=32 max_quantizer=32 ! "
                 "webmmux ! filesink location={save_video} ").format(
-                src=src, save_video=save_video)
+                src=src, overlay=overlay, save_video=save_video)
 
         if user_sink_pipeline:
             sink_pipeline_description += (
-                "{src} ! videoconvert ! {user_sink_pipeline}").format(
-                src=src, user_sink_pipeline=user_sink_pipeline)
+                "{src} ! videoconvert ! {overlay}{user_sink_pipeline}").format(
+                src=src, overlay=overlay,
+                user_sink_pipeline=user_sink_pipeline)
 
         self.sink_pipeline = Gst.parse_launch(sink_pipeline_description)
         sink_bus = self.sink_pipeline.get_bus()
@@ -680,6 +809,10 @@ class SinkPipeline(object):
         sink_bus.connect("message::eos", self._on_eos_from_sink_pipeline)
         sink_bus.add_signal_watch()
         self.appsrc = self.sink_pipeline.get_by_name("appsrc")
+        if self._overlays is not None:
+            for elem in gst_iterate(self.sink_pipeline.iterate_elements()):
+                if elem.get_factory().get_name() == "overlaycomposition":
+                    elem.connect("draw", self._on_draw_overlay)
 
         debug("sink pipeline: %s" % sink_pipeline_description)
 
@@ -726,6 +859,7 @@ class SinkPipeline(object):
         # Drain the frame queue
         while self._frames:
             self._push_sample(self._frames.pop())
+        self._frames_nbytes = 0
 
         if self._sample_count > 0:
             state = self.sink_pipeline.get_state(0)
@@ -755,12 +889,19 @@ class SinkPipeline(object):
         """
         now = sample.time
         self._frames.appendleft(sample)
+        self._frames_nbytes += sample.get_buffer().get_size()
 
+        # If we're holding on to more than `_max_buffered_bytes` of video
+        # (high-resolution, high-frame-rate video) we push the oldest frames
+        # early, so annotations that the test script draws later than that
+        # won't appear on them.
         while self._frames:
             oldest = self._frames.pop()
-            if oldest.time > now - self._sink_latency_secs:
+            if (oldest.time > now - self._sink_latency_secs and
+                    self._frames_nbytes <= self._max_buffered_bytes):
                 self._frames.append(oldest)
                 break
+            self._frames_nbytes -= oldest.get_buffer().get_size()
             self._push_sample(oldest)
 
     def _push_sample(self, sample):
@@ -778,26 +919,41 @@ class SinkPipeline(object):
                 if now >= annotation.time:
                     self.annotations.remove(annotation)
 
-        sample = gst_sample_make_writable(sample)
-        img = array_from_sample(sample, readwrite=True)
         # Text:
-        _draw_text(
-            img, datetime.datetime.now().strftime("%H:%M:%S.%f")[:-4],
-            (10, 30), (255, 255, 255))
+        drawables = [_TextLabel(
+            datetime.datetime.now().strftime("%H:%M:%S.%f")[:-4],
+            (10, 30), (255, 255, 255))]
         for i, x in enumerate(reversed(current_texts)):
             origin = (10, (i + 2) * 30)
             age = float(now - x.time) / 3
             color = (int(255 * max([1 - age, 0.5])),) * 3
-            _draw_text(img, x.text, origin, color)
+            drawables.append(_TextLabel(x.text, origin, color))
 
         # Regions:
-        for annotation in annotations:
-            annotation.draw(img)
+        drawables.extend(annotations)
+
+        if self._overlays is None:
+            sample = gst_sample_make_writable(sample)
+            img = array_from_sample(sample, readwrite=True)
+            for x in drawables:
+                x.draw(img)
+        else:
+            composition = overlay_composition(
+                _draw_overlay_images(array_from_sample(sample), drawables))
+            with self._overlays_lock:
+                self._overlays[sample.get_buffer().pts] = composition
+                while len(self._overlays) > 100:
+                    self._overlays.popitem(last=False)
 
         self.appsrc.props.caps = sample.get_caps()
         self.appsrc.emit("push-buffer", sample.get_buffer())
         self._sample_count += 1
 
+    def _on_draw_overlay(self, _overlaycomposition, sample):
+        # Called from the sink pipeline's streaming thread.
+        with self._overlays_lock:
+            return self._overlays.get(sample.get_buffer().pts)
+
     def draw(self, obj, duration_secs=None, label=""):
         with self.annotations_lock:
             if isinstance(obj, (str, unicode)):
@@ -817,6 +973,51 @@ class SinkPipeline(object):
                     "Can't draw object of type '%s'" % type(obj).__name__)
 
 
+def _overlaycomposition_available():
+    if Gst.ElementFactory.find("overlaycomposition") is None:
+        return False
+    try:
+        gi.require_version("GstVideo", "1.0")
+    except ValueError:
+        return False
+    return True
+
+
+def _draw_overlay_images(frame, drawables):
+    """Draws `drawables` on copies of the parts of `frame` that they cover, so
+    that we only copy the pixels that we draw on. Drawables that overlap are
+    drawn (in order) on the same copy, so the result is the same as drawing
+    them all on the whole frame.
+
+    :returns: A list of ``(x, y, image)`` tuples for `overlay_composition`.
+    """
+    frame_region = Region(0, 0, frame.shape[1], frame.shape[0])
+    groups = []  # List of (region, [drawable])
+    for x in drawables:
+        group = (Region.intersect(x.bounding_box, frame_region), [x])
+        if group[0] is None:
+            continue
+        merged = True
+        while merged:
+            merged = False
+            for g in groups:
+                if Region.intersect(g[0], group[0]):
+                    groups.remove(g)
+                    group = (Region.bounding_box(g[0], group[0]),
+                             g[1] + group[1])
+                    merged = True
+                    break
+        groups.append(group)
+
+    out = []
+    for region, group in groups:
+        img = frame[region.to_slice()].copy()
+        for x in group:
+            x.draw(img, offset=(-region.x, -region.y))
+        out.append((region.x, region.y, img))
+    return out
+
+
 class NoSinkPipeline(object):
     """
     Used in place of a SinkPipeline when no video output is required.  Is a lot
@@ -839,15 +1040,63 @@ class NoSinkPipeline(object):
         pass
 
 
+class _FrameBuffer(object):
+    """The most recent frames received by `Display`, oldest first.
+
+    Holds at most `depth` frames, and at most `max_bytes` of frame data (but
+    always at least the most recent frame). Not thread-safe: `Display`
+    protects it with its `_condition`.
+    """
+    def __init__(self, depth=1, max_bytes=None):
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self._frames = deque()
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def append(self, frame):
+        self._frames.append(frame)
+        self._nbytes += frame.nbytes
+        while len(self._frames) > 1 and (
+                len(self._frames) > self.depth or
+                self.max_bytes is not None and self._nbytes > self.max_bytes):
+            self._nbytes -= self._frames.popleft().nbytes
+
+    def latest(self, since):
+        """The most recent frame, if it's newer than `since` (a timestamp)."""
+        if self._frames and self._frames[-1].time > since:
+            return self._frames[-1]
+        return None
+
+    def next_after(self, since):
+        """The oldest frame newer than `since` (a timestamp)."""
+        for frame in self._frames:
+            if frame.time > since:
+                return frame
+        return None
+
+
 class Display(object):
     def __init__(self, user_source_pipeline, sink_pipeline,
-                 restart_source=False, source_teardown_eos=False):
+                 restart_source=False, source_teardown_eos=False,
+                 frame_buffer_depth=1, frame_buffer_max_bytes=None,
+                 gray_stream_scale=0, videoconvert_threads=1,
+                 decoder_threads=0):
 
         import time
 
-        self._condition = threading.Condition()  # Protects last_frame
+        # Protects last_frame, _frames and _gray_frames
+        self._condition = threading.Condition()
         self.last_frame = None
+        self._frames = _FrameBuffer(frame_buffer_depth, frame_buffer_max_bytes)
+        # Low-resolution grayscale frames from `gray_appsink`, by timestamp:
+        self._gray_frames = OrderedDict()
+        self.gray_stream_scale = gray_stream_scale
+        self.decoder_threads = decoder_threads
         self.last_used_frame = None
+        self.frames_received = 0
         self.source_pipeline = None
         self.init_time = time.time()
         self.underrun_timeout = None
@@ -868,15 +1117,42 @@ class Display(object):
         #   have enough horse-power to decode the incoming stream and any delays
         #   will be transient otherwise it could start filling up causing
         #   increased latency.
+        # * If `gray_stream_scale` is set we also deliver a low-resolution
+        #   grayscale copy of each frame to `gray_appsink`, for analysis that
+        #   doesn't need full-resolution colour frames (see
+        #   `imgutils._low_res_gray`). The tee goes before
+        #   _stbt_raw_frames_queue, so the main branch has no extra queue (and
+        #   no extra latency), and the grayscale branch has its own leaky queue
+        #   so that it never holds up the main branch. `_stbt_gray_caps` is set
+        #   to the scaled size when we know the video's size (see
+        #   `on_source_caps`).
+        # * Converting high-resolution video to BGR can take longer than the
+        #   video's frame interval, so `videoconvert_threads` can split it
+        #   across several threads (GStreamer 1.12+). The default of 1 doesn't
+        #   set `n-threads` at all, so it works with older versions.
+        videoconvert = "videoconvert"
+        if videoconvert_threads != 1:
+            videoconvert += " n-threads=%d" % videoconvert_threads
+        raw_frames = " ! ".join([
+            'queue name=_stbt_raw_frames_queue max-size-buffers=2',
+            videoconvert,
+            "video/x-raw,format=BGR",
+            appsink])
+        if gray_stream_scale:
+            raw_frames = " ".join([
+                "tee name=_stbt_tee !", raw_frames,
+                "_stbt_tee. ! queue max-size-buffers=2 leaky=downstream ! "
+                "videoconvert ! videoscale ! "
+                "capsfilter name=_stbt_gray_caps "
+                "caps=video/x-raw,format=GRAY8 ! "
+                "appsink name=gray_appsink max-buffers=1 drop=true sync=true "
+                "emit-signals=true"])
         self.source_pipeline_description = " ! ".join([
             user_source_pipeline,
             'queue name=_stbt_user_data_queue max-size-buffers=0 '
             '    max-size-bytes=0 max-size-time=10000000000',
-            "decodebin",
-            'queue name=_stbt_raw_frames_queue max-size-buffers=2',
-            'videoconvert',
-            'video/x-raw,format=BGR',
-            appsink])
+            "decodebin name=_stbt_decodebin",
+            raw_frames])
         self.create_source_pipeline()
 
         self._sink_pipeline = sink_pipeline
@@ -893,6 +1169,15 @@ class Display(object):
         source_bus.add_signal_watch()
         appsink = self.source_pipeline.get_by_name("appsink")
         appsink.connect("new-sample", self.on_new_sample)
+        if self.decoder_threads:
+            self.source_pipeline.get_by_name("_stbt_decodebin").connect(
+                "element-added", self.on_decodebin_element_added)
+        if self.gray_stream_scale:
+            self.source_pipeline.get_by_name("gray_appsink").connect(
+                "new-sample", self.on_new_gray_sample)
+            self.source_pipeline.get_by_name("_stbt_tee").get_static_pad(
+                "sink").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM,
+                                  self.on_source_caps)
 
         # A realtime clock gives timestamps compatible with time.time()
         self.source_pipeline.use_clock(
@@ -914,13 +1199,40 @@ class Display(object):
                 .set_property('leaky', 'downstream')
             self.source_pipeline.get_by_name('appsink') \
                 .set_property('sync', False)
+            if self.gray_stream_scale:
+                self.source_pipeline.get_by_name('gray_appsink') \
+                    .set_property('sync', False)
 
         self.source_pipeline.set_state(Gst.State.PLAYING)
 
+    def on_decodebin_element_added(self, _bin, element):
+        if isinstance(element, Gst.Bin):
+            # The decoder may be nested in a child bin (e.g. decodebin3's
+            # parsebin, or a decodebin inside another decodebin). We don't use
+            # "deep-element-added" because it needs GStreamer 1.10.
+            element.connect("element-added", self.on_decodebin_element_added)
+            for child in gst_iterate(element.iterate_elements()):
+                self.on_decodebin_element_added(element, child)
+            return
+        # Software decoders call their thread-count property different things:
+        # "max-threads" (avdec_*), "threads" (vp8dec, vp9dec) or "n-threads".
+        for name in ["max-threads", "threads", "n-threads"]:
+            if element.find_property(name) is not None:
+                debug("Setting %s=%d on %s" % (
+                    name, self.decoder_threads, element.get_name()))
+                element.set_property(name, self.decoder_threads)
+                break
+
     def get_frame(self, timeout_secs=10, since=None):
+        """Without `since`, returns the most recent frame. With `since` (a
+        timestamp), returns the oldest frame newer than `since` that is still
+        in the frame buffer, so that `DeviceUnderTest.frames` can iterate over
+        the buffered frames in order.
+        """
         import time
         t = time.time()
         end_time = t + timeout_secs
+        in_order = since is not None
         if since is None:
             # If you want to wait 10s for a frame you're probably not interested
             # in a frame from 10s ago.
@@ -928,12 +1240,15 @@ class Display(object):
 
         with self._condition:
             while True:
-                if (isinstance(self.last_frame, Frame) and
-                        self.last_frame.time > since):
-                    self.last_used_frame = self.last_frame
-                    return self.last_frame
-                elif isinstance(self.last_frame, Exception):
+                if isinstance(self.last_frame, Exception):
                     raise RuntimeError(str(self.last_frame))
+                if in_order:
+                    frame = self._frames.next_after(since)
+                else:
+                    frame = self._frames.latest(since)
+                if frame is not None:
+                    self.last_used_frame = frame
+                    return frame
                 t = time.time()
                 if t > end_time:
                     break
@@ -945,13 +1260,16 @@ class Display(object):
                 pipeline, Gst.DebugGraphDetails.ALL, "NoVideo")
         raise NoVideo("No video")
 
+    @staticmethod
+    def _sample_time(appsink, sample):
+        running_time = sample.get_segment().to_running_time(
+            Gst.Format.TIME, sample.get_buffer().pts)
+        return float(appsink.base_time + running_time) / 1e9
+
     def on_new_sample(self, appsink):
         sample = appsink.emit("pull-sample")
 
-        running_time = sample.get_segment().to_running_time(
-            Gst.Format.TIME, sample.get_buffer().pts)
-        sample.time = (
-            float(appsink.base_time + running_time) / 1e9)
+        sample.time = self._sample_time(appsink, sample)
 
         if (sample.time > self.init_time + 31536000 or
                 sample.time < self.init_time - 31536000):  # 1 year
@@ -963,14 +1281,58 @@ class Display(object):
 
         # See also: logging.draw_on
         frame._draw_sink = weakref.ref(self._sink_pipeline)  # pylint: disable=protected-access
+        if self.gray_stream_scale:
+            # See also: imgutils._low_res_gray
+            frame._gray_stream = weakref.ref(self)  # pylint: disable=protected-access
+
+        # So that `DeviceUnderTest.frames` can tell how many frames it skipped:
+        self.frames_received += 1
+        frame._sequence_number = self.frames_received  # pylint: disable=protected-access
         self.tell_user_thread(frame)
         self._sink_pipeline.on_sample(sample)
         return Gst.FlowReturn.OK
 
+    def on_source_caps(self, _pad, info):
+        event = info.get_event()
+        if event.type == Gst.EventType.CAPS:
+            s = event.parse_caps().get_structure(0)
+            _, width = s.get_int("width")
+            _, height = s.get_int("height")
+            # Rows of GRAY8 video are padded to a multiple of 4 bytes, so we
+            # make the width a multiple of 4 to get unpadded numpy arrays:
+            width = max(4, int(width * self.gray_stream_scale) // 4 * 4)
+            height = max(1, int(round(height * self.gray_stream_scale)))
+            caps = Gst.Caps.from_string(
+                "video/x-raw,format=GRAY8,width=%d,height=%d" % (width, height))
+            debug("gray stream: %s" % caps.to_string())
+            self.source_pipeline.get_by_name("_stbt_gray_caps").set_property(
+                "caps", caps)
+        return Gst.PadProbeReturn.OK
+
+    def on_new_gray_sample(self, appsink):
+        sample = appsink.emit("pull-sample")
+        t = self._sample_time(appsink, sample)
+        frame = array_from_sample(sample)
+        frame.flags.writeable = False
+        with self._condition:
+            self._gray_frames[t] = frame
+            # We only need the grayscale version of frames that the test
+            # script might still be looking at:
+            while len(self._gray_frames) > self._frames.depth + 4:
+                self._gray_frames.popitem(last=False)
+        return Gst.FlowReturn.OK
+
+    def get_gray_frame(self, t):
+        """The low-resolution grayscale version of the frame with timestamp
+        `t`, or None if we don't have it.
+        """
+        with self._condition:
+            return self._gray_frames.get(t)
+
     def tell_user_thread(self, frame_or_exception):
-        # `self.last_frame` is how we communicate from this thread (the GLib
-        # main loop) to the main application thread running the user's script.
-        # Note that only this thread writes to self.last_frame.
+        # `self.last_frame` and `self._frames` are how we communicate from this
+        # thread (the GLib main loop) to the main application thread running
+        # the user's script. Note that only this thread writes to them.
 
         if isinstance(frame_or_exception, Exception):
             ddebug("glib thread: reporting exception to user thread: %s" %
@@ -981,6 +1343,8 @@ class Display(object):
 
         with self._condition:
             self.last_frame = frame_or_exception
+            if isinstance(frame_or_exception, Frame):
+                self._frames.append(frame_or_exception)
             self._condition.notify_all()
 
     def on_error(self, _bus, message):
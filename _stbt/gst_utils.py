@@ -26,10 +26,44 @@ def gst_sample_make_writable(sample):
             sample.get_info())
 
 
+def overlay_composition(images):
+    """Creates a `GstVideoOverlayComposition` that draws each of the given
+    BGR images (a list of ``(x, y, image)`` tuples) on top of the video at the
+    given position. Returns None if `images` is empty.
+
+    Requires the GstVideo GObject-introspection bindings.
+    """
+    gi.require_version("GstVideo", "1.0")
+    from gi.repository import GstVideo  # pylint:disable=wrong-import-order
+
+    import cv2
+
+    composition = None
+    for x, y, image in images:
+        height, width = image.shape[:2]
+        # Overlay rectangles are ARGB in native byte order (i.e. BGRA on
+        # little-endian machines):
+        pixels = Gst.Buffer.new_wrapped(
+            cv2.cvtColor(image, cv2.COLOR_BGR2BGRA).tobytes())
+        GstVideo.buffer_add_video_meta(
+            pixels, GstVideo.VideoFrameFlags.NONE, GstVideo.VideoFormat.BGRA,
+            width, height)
+        rectangle = GstVideo.VideoOverlayRectangle.new_raw(
+            pixels, x, y, width, height,
+            GstVideo.VideoOverlayFormatFlags.NONE)
+        if composition is None:
+            composition = GstVideo.VideoOverlayComposition.new(rectangle)
+        else:
+            composition.add_rectangle(rectangle)
+    return composition
+
+
 def sample_shape(sample):
     caps = sample.get_caps().get_structure(0)
     if caps.get_value('format') in ['BGR', 'RGB']:
         return (caps.get_value('height'), caps.get_value('width'), 3)
+    elif caps.get_value('format') == 'GRAY8':
+        return (caps.get_value('height'), caps.get_value('width'))
     else:
         return (sample_get_size(sample),)
 
@@ -7,31 +7,40 @@ and call the function within the scope of a `with imgproc_cache.cache():`
 context manager. For now this is a private API but we intend to make it public
 at some point so that users can add caching to any custom image-processing
 functions in their test-packs.
+
+The size of the cache is limited by ``max_size_mb`` in the ``[cache]`` section
+of the stbt config file. When the cached results take up more than that, we
+remove the least-recently-used results (see `_Cache.evict`).
 """
 
 import functools
 import inspect
 import itertools
 import json
+import marshal
 import os
+import struct
 import sys
+import time
+import zlib
 from contextlib import contextmanager
 from distutils.version import LooseVersion
 
 import lmdb
 import numpy
 
-from _stbt.logging import ImageLogger
-from _stbt.utils import mkdir_p, named_temporary_directory, scoped_curdir
+from _stbt.config import get_config
+from _stbt.logging import debug, ImageLogger
+from _stbt.utils import (LRUCache, mkdir_p, named_temporary_directory,
+                         scoped_curdir)
 
 
-MAX_CACHE_SIZE_BYTES = 1024 * 1024 * 1024  # 1GiB
 _cache = None
 _cache_full_warning = None
 
 
 @contextmanager
-def cache(filename=None):
+def cache(filename=None, max_size_mb=None):
     if os.environ.get('STBT_DISABLE_CACHING'):
         yield
         return
@@ -44,14 +53,232 @@ def cache(filename=None):
             or '%s/.cache' % os.environ['HOME']
         mkdir_p(cache_home + "/stbt")
         filename = cache_home + "/stbt/cache.lmdb"
-    with lmdb.open(filename, map_size=MAX_CACHE_SIZE_BYTES) as db:  # pylint: disable=no-member
+    if max_size_mb is None:
+        max_size_mb = get_config("cache", "max_size_mb", type_=float)
+    max_size = int(max_size_mb * 1024 * 1024)
+
+    # LMDB needs some free space in the map for its copy-on-write B-tree
+    # pages (even to delete entries), so we give it twice `max_size`. The file
+    # on disk is sparse, so this doesn't use the extra space unless it needs
+    # it.
+    with lmdb.open(filename, map_size=2 * max_size, max_dbs=2) as env:  # pylint: disable=no-member
         assert _cache is None
         try:
-            _cache = db
+            _cache = _Cache(env, max_size)
             _cache_full_warning = False
             yield
         finally:
-            _cache = None
+            try:
+                _cache.flush()
+            finally:
+                _cache = None
+
+
+class _Cache(object):
+    """The LMDB environment that stores the cached results.
+
+    There are 2 databases in the environment, both keyed by the hash from
+    `_cache_hash`: "results" (the results, encoded by `_dumps`) and
+    "access-times" (when each result was last written or read, as a
+    little-endian double).
+
+    LMDB only allows one write transaction at a time (across all the
+    processes using the cache), so we write as little as possible:
+
+    * Reading a result doesn't update its access time in the database
+      straight away. Instead we remember the access times in memory (in
+      `_accessed`: a dict of key to `(time, number of items)`, where the
+      number of items is None except for `get_sequence`).
+    * New results are queued in memory (in `_pending`).
+
+    `flush` writes them all in a single transaction when the queue is big
+    enough or old enough, before evicting results, and when the cache is
+    closed.
+
+    Recently used results are also kept in memory (in `_recent`), so that
+    cache hits don't need an LMDB transaction at all.
+    """
+
+    # When the cache is bigger than `max_size` we evict results until it's
+    # this fraction of `max_size`, so that we don't have to evict again
+    # straight away:
+    EVICT_TO = 0.75
+
+    # Maximum size of `_recent`, in bytes. Each entry counts as an extra
+    # `RECENT_ENTRY_OVERHEAD` bytes (roughly the memory used by the key and
+    # the dict entry) so this also limits the number of entries.
+    RECENT_MAX_SIZE = 64 * 1024 * 1024
+    RECENT_ENTRY_OVERHEAD = 256
+
+    # We flush `_pending` when it has this many results, or this many bytes
+    # (or 10% of `max_size`, if that's smaller, so that the flush can't fill
+    # the map), or when its oldest result was queued this many seconds ago:
+    FLUSH_COUNT = 100
+    FLUSH_SIZE = 1024 * 1024
+    FLUSH_INTERVAL_SECS = 1.0
+
+    def __init__(self, env, max_size):
+        self.env = env
+        self.max_size = max_size
+        self._flush_size = min(self.FLUSH_SIZE, max_size // 10)
+        self._results = env.open_db(b"results")
+        self._access_times = env.open_db(b"access-times")
+        self._accessed = {}
+        self._recent = self._new_recent()
+        self._pending = {}
+        self._pending_size = 0
+        self._pending_since = None
+
+        with env.begin(write=True) as txn:
+            # Remove results written by older versions of stb-tester, which
+            # stored them in the main database without access times:
+            for key in list(txn.cursor().iternext(values=False)):
+                if key not in (b"results", b"access-times"):
+                    txn.delete(key)
+
+        if self.size() > self.max_size:
+            self.evict()
+
+    def path(self):
+        return self.env.path()
+
+    def _new_recent(self):
+        return LRUCache(
+            self.RECENT_MAX_SIZE,
+            sizeof=lambda v: (sum(len(x) for x in v) if isinstance(v, tuple)
+                              else len(v)) + self.RECENT_ENTRY_OVERHEAD)
+
+    def get(self, key):
+        """Returns the encoded result for `key`, or None if it isn't cached.
+        """
+        value = self._pending.get(key) or self._recent.get(key)
+        if value is None:
+            with self.env.begin() as txn:
+                value = txn.get(key, db=self._results)
+            if value is None:
+                return None
+            self._recent[key] = value
+        self._accessed[key] = (time.time(), None)
+        return value
+
+    def get_sequence(self, key, last):
+        """Returns a list of the encoded results for `key + "0"`,
+        `key + "1"`, etc. (as stored by `memoize_iterator`), up to the first
+        one that isn't cached or that is equal to `last`.
+
+        Complete sequences (ending with `last`) are kept in `_recent` as a
+        single entry; otherwise we read them in a single LMDB transaction.
+        """
+        values = self._recent.get(key)
+        if values is None:
+            values = []
+            with self.env.begin() as txn:
+                for i in itertools.count():
+                    value = (self._pending.get(key + str(i)) or
+                             txn.get(key + str(i), db=self._results))
+                    if value is None:
+                        break
+                    values.append(value)
+                    if value == last:
+                        self._recent[key] = tuple(values)
+                        break
+        if values:
+            self._accessed[key] = (time.time(), len(values))
+        return list(values)
+
+    def put(self, key, value):
+        """Queues `value` to be written to the cache (see `flush`)."""
+        now = time.time()
+        if not self._pending:
+            self._pending_since = now
+        self._pending_size += len(value) - len(self._pending.get(key, b""))
+        self._pending[key] = value
+        self._accessed[key] = (now, None)
+        if (len(self._pending) >= self.FLUSH_COUNT or
+                self._pending_size >= self._flush_size or
+                now - self._pending_since >= self.FLUSH_INTERVAL_SECS):
+            self.flush()
+
+    def flush(self):
+        """Writes the queued results and the access times to the database,
+        in a single transaction. Evicts old results if the cache is too big.
+        """
+        try:
+            size = self._write()
+        except lmdb.MapFullError:  # pylint: disable=no-member
+            # We evict results before the cache gets this full, so this
+            # should only happen if the queued results are bigger than the
+            # free space.
+            _warn_cache_full(self.path())
+            return
+        if size > self.max_size:
+            self.evict()
+
+    def _write(self):
+        """Implementation of `flush`. Returns the size of the cache."""
+        if not self._pending and not self._accessed:
+            return self.size()
+        pending, self._pending = self._pending, {}
+        self._pending_size = 0
+        accessed, self._accessed = self._accessed, {}
+        with self.env.begin(write=True) as txn:
+            for key, value in pending.items():
+                txn.put(key, value, db=self._results)
+            for key, (t, n) in accessed.items():
+                if n is not None:
+                    keys = [key + str(i) for i in range(n)]
+                else:
+                    keys = [key]
+                for k in keys:
+                    # Don't resurrect the access time of a result that
+                    # another process has evicted:
+                    if txn.get(k, db=self._results) is not None:
+                        txn.put(k, struct.pack("<d", t),
+                                db=self._access_times)
+            return self._size(txn)
+
+    def size(self):
+        """The number of bytes used by the cached results."""
+        with self.env.begin() as txn:
+            return self._size(txn)
+
+    def _size(self, txn):
+        size = 0
+        for stat in (txn.stat(), txn.stat(self._results),
+                     txn.stat(self._access_times)):
+            size += stat["psize"] * (stat["branch_pages"] +
+                                     stat["leaf_pages"] +
+                                     stat["overflow_pages"])
+        return size
+
+    def evict(self):
+        """Remove the least-recently-used results until the cache is
+        ``EVICT_TO * max_size`` bytes.
+        """
+        self._write()
+        self._recent = self._new_recent()
+        target = self.EVICT_TO * self.max_size
+        with self.env.begin() as txn:
+            size_before = size = self._size(txn)
+            entries = sorted(
+                (struct.unpack("<d", t)[0], key)
+                for key, t in txn.cursor(db=self._access_times))
+
+        # Delete in small batches so that each transaction needs little free
+        # space in the map.
+        evicted = 0
+        while size > target and evicted < len(entries):
+            with self.env.begin(write=True) as txn:
+                for _, key in entries[evicted:evicted + 100]:
+                    txn.delete(key, db=self._results)
+                    txn.delete(key, db=self._access_times)
+                    evicted += 1
+                    size = self._size(txn)
+                    if size <= target:
+                        break
+
+        debug("Image processing cache: Evicted %d least-recently-used "
+              "results (%d bytes to %d bytes)" % (evicted, size_before, size))
 
 
 def memoize(additional_fields=None):
@@ -65,11 +292,15 @@ def memoize(additional_fields=None):
 
     **Constraints**
 
-    * The decorated function's arguments must be simple JSON serialisable
-      values or an image in the form of a numpy.ndarray.
+    * The decorated function's arguments must be simple values (None, bool,
+      numbers, strings, and lists, tuples, sets or dicts of simple values) or
+      an image in the form of a numpy.ndarray (see `_encode`). Subclasses of
+      these types (like namedtuples) are treated as their base type. If any
+      other value is passed, the function is called without the cache.
     * The return value from the function must be JSON serialisable and should
       be round-trippable via JSON. This means that unicode objects should be
-      returned rather than string objects.
+      returned rather than string objects. (We store most values in a more
+      compact format, see `_dumps`, but JSON is the fallback.)
     * For the sake of speed we use a non-cryptographic hash function.  This
       means someone could deliberately cause a hash-collision by carefully
       constructing arguments to your function.  Don't use memoize on functions
@@ -93,21 +324,21 @@ def memoize(additional_fields=None):
     def decorator(function):
         func_key = json.dumps([function.__name__, additional_fields],
                               sort_keys=True)
+        bind = _arg_binder(function)
 
         @functools.wraps(function)
         def inner(*args, **kwargs):
             try:
                 if _cache is None:
                     raise NotCachable()
-                full_kwargs = inspect.getcallargs(function, *args, **kwargs)
+                full_kwargs = bind(*args, **kwargs)
                 key = _cache_hash((func_key, full_kwargs))
             except NotCachable:
                 return function(*args, **kwargs)
 
-            with _cache.begin() as txn:
-                out = txn.get(key)
+            out = _cache.get(key)
             if out is not None:
-                return json.loads(out)
+                return _loads(out)
             output = function(**full_kwargs)
             _cache_put(key, output)
             return output
@@ -125,30 +356,28 @@ def memoize_iterator(additional_fields=None):
     def decorator(function):
         func_key = json.dumps([function.__name__, additional_fields],
                               sort_keys=True)
+        bind = _arg_binder(function)
 
         @functools.wraps(function)
         def inner(*args, **kwargs):
             try:
                 if _cache is None:
                     raise NotCachable()
-                full_kwargs = inspect.getcallargs(function, *args, **kwargs)
+                full_kwargs = bind(*args, **kwargs)
                 key = _cache_hash((func_key, full_kwargs))
             except NotCachable:
                 for x in function(*args, **kwargs):
                     yield x
                 return
 
-            for i in itertools.count():
-                with _cache.begin() as txn:
-                    out = txn.get(key + str(i))
-                if out is None:
-                    break
-                out_, stop_ = json.loads(out)
+            cached = _cache.get_sequence(key, last=_STOP_ITERATION)
+            for out in cached:
+                out_, stop_ = _loads(out)
                 if stop_:
                     raise StopIteration()
                 yield out_
 
-            skip = i  # pylint:disable=undefined-loop-variable
+            skip = len(cached)
             it = function(**full_kwargs)
             for i in itertools.count():
                 try:
@@ -157,70 +386,249 @@ def memoize_iterator(additional_fields=None):
                         _cache_put(key + str(i), [output, None])
                         yield output
                 except StopIteration:
-                    _cache_put(key + str(i), [None, "StopIteration"])
+                    _cache_put(key + str(i), _STOP_ITERATION_VALUE)
                     raise
 
         return inner
     return decorator
 
 
+# Cached values are stored in a binary format: A single byte that specifies
+# the format, followed by the value in that format.
+_MARSHAL = b"\x01"
+_MARSHAL_ZLIB = b"\x02"
+_JSON = b"\x03"
+
+# Values bigger than this (in bytes) are compressed, if that makes them
+# smaller:
+_COMPRESS_MIN_SIZE = 1024
+
+
+def _dumps(value):
+    """Serialises a result for the cache.
+
+    We use `marshal` because it's compact, and much faster to decode than
+    JSON. Large values (such as hOCR XML from `ocr`) are compressed with
+    zlib's fastest setting. `marshal` only supports the built-in types
+    (not subclasses), so for other values we fall back to JSON.
+    """
+    try:
+        data = marshal.dumps(value, 2)
+    except ValueError:
+        return _JSON + json.dumps(value).encode("utf-8")
+    if len(data) > _COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            return _MARSHAL_ZLIB + compressed
+    return _MARSHAL + data
+
+
+def _loads(data):
+    """Deserialises a result written by `_dumps`."""
+    format_ = data[:1]
+    if format_ == _MARSHAL:
+        return marshal.loads(data[1:])
+    elif format_ == _MARSHAL_ZLIB:
+        return marshal.loads(zlib.decompress(data[1:]))
+    elif format_ == _JSON:
+        return json.loads(data[1:])
+    else:
+        raise ValueError("Unknown format %r for cached value" % format_)
+
+
+# What `memoize_iterator` stores after the last item:
+_STOP_ITERATION_VALUE = [None, "StopIteration"]
+_STOP_ITERATION = _dumps(_STOP_ITERATION_VALUE)
+
+
 def _cache_put(key, value):
-    with _cache.begin(write=True) as txn:
-        try:
-            txn.put(key, json.dumps(value).encode("utf-8"))
-        except lmdb.MapFullError:  # pylint: disable=no-member
-            global _cache_full_warning
-            if not _cache_full_warning:
-                sys.stderr.write(
-                    "Image processing cache is full.  This will "
-                    "cause degraded performance.  Consider "
-                    "deleting the cache file (%s) to purge old "
-                    "results\n" % _cache.path())
-                _cache_full_warning = True
+    _cache.put(key, _dumps(value))
+
+
+def _warn_cache_full(path):
+    global _cache_full_warning
+    if not _cache_full_warning:
+        sys.stderr.write(
+            "Image processing cache is full.  This will "
+            "cause degraded performance.  Consider "
+            "increasing max_size_mb in the [cache] section of "
+            "your stbt config file (the cache is %s)\n" % path)
+        _cache_full_warning = True
 
 
 class NotCachable(Exception):
     pass
 
 
-class _ArgsEncoder(json.JSONEncoder):
-    def default(self, o):  # pylint:disable=method-hidden
-        from _stbt.match import MatchParameters
-        if isinstance(o, ImageLogger):
-            if o.enabled:
-                raise NotCachable()
-            return None
-        elif isinstance(o, LooseVersion):
-            return str(o)
-        elif isinstance(o, set):
-            return sorted(o)
-        elif isinstance(o, MatchParameters):
-            return {
-                "match_method": o.match_method.value,
-                "match_threshold": o.match_threshold,
-                "confirm_method": o.confirm_method.value,
-                "confirm_threshold": o.confirm_threshold,
-                "erode_passes": o.erode_passes}
-        elif isinstance(o, numpy.ndarray):
-            from _stbt.xxhash import Xxhash64
-            h = Xxhash64()
-            h.update(numpy.ascontiguousarray(o).data)
-            return (o.shape, h.hexdigest())
-        else:
-            json.JSONEncoder.default(self, o)
+def _arg_binder(function):
+    """Returns a function that converts the `*args` and `**kwargs` of a call to
+    `function` into a dict of all of its arguments (including the default
+    values), like `inspect.getcallargs` but faster.
+
+    We only use `inspect.getcallargs` for functions with ``*args`` or
+    ``**kwargs``, and to raise the appropriate `TypeError` for invalid calls.
+    """
+    argspec = inspect.getargspec(function)
+    if argspec.varargs or argspec.keywords:
+        return functools.partial(inspect.getcallargs, function)
+
+    names = argspec.args
+    defaults = dict(zip(reversed(names), reversed(argspec.defaults or ())))
+
+    def bind(*args, **kwargs):
+        if len(args) <= len(names):
+            out = defaults.copy()
+            out.update(zip(names, args))
+            if kwargs and not any(k in kwargs for k in names[:len(args)]):
+                out.update(kwargs)
+            elif kwargs:
+                # Multiple values for the same argument:
+                return inspect.getcallargs(function, *args, **kwargs)
+            if len(out) == len(names):
+                return out
+        # Wrong number of arguments or an unexpected keyword argument:
+        return inspect.getcallargs(function, *args, **kwargs)
+
+    return bind
 
 
 def _cache_hash(value):
+    """Hashes `value` (typically the arguments of a memoized function).
+
+    The small values are serialised into one string, so that we only update
+    the hash once for them (each call to `Xxhash64.update` has quite a lot of
+    overhead); numpy arrays are hashed in place, without copying them.
+    """
     from _stbt.xxhash import Xxhash64
     h = Xxhash64()
+    parts = []
+    _encode(value, parts, h)
+    h.update(b"".join(parts))
+    return h.digest()
 
-    class HashWriter(object):
-        def write(self, data):
-            h.update(data)
-            return len(data)
 
-    json.dump(value, HashWriter(), cls=_ArgsEncoder, sort_keys=True)
-    return h.digest()
+def _encode(o, parts, h):
+    # Each value is prefixed with its type and (if variable) its length, so
+    # that different values can't have the same encoding.
+    try:
+        encoder = _ENCODERS[type(o)]
+    except KeyError:
+        # Subclasses of the built-in types (like `enum.IntEnum`,
+        # `numpy.float64` or namedtuples) are encoded the same as their base
+        # type.
+        for base, encoder in _SUBCLASS_ENCODERS:
+            if isinstance(o, base):
+                break
+        else:
+            _encode(_key_value(o), parts, h)
+            return
+    encoder(o, parts, h)
+
+
+def _encode_none(_, parts, _h):
+    parts.append(b"N")
+
+
+def _encode_bool(o, parts, _h):
+    parts.append(b"T" if o else b"F")
+
+
+def _encode_int(o, parts, _h):
+    parts.append(b"i%d;" % o)
+
+
+def _encode_float(o, parts, _h):
+    parts.append(b"f%r;" % o)
+
+
+def _encode_str(o, parts, _h):
+    parts.append(b"s%d:" % len(o))
+    parts.append(o)
+
+
+def _encode_unicode(o, parts, h):
+    _encode_str(o.encode("utf-8"), parts, h)
+
+
+def _encode_list(o, parts, h):
+    parts.append(b"l%d:" % len(o))
+    for x in o:
+        _encode(x, parts, h)
+
+
+def _encode_dict(o, parts, h):
+    parts.append(b"d%d:" % len(o))
+    for k in sorted(o):
+        _encode(k, parts, h)
+        _encode(o[k], parts, h)
+
+
+def _encode_ndarray(o, parts, h):
+    parts.append(b"a%s%r:" % (o.dtype.str, o.shape))
+    h.update(b"".join(parts))
+    del parts[:]
+    h.update(numpy.ascontiguousarray(o).data)
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    long: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    unicode: _encode_unicode,
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+    numpy.ndarray: _encode_ndarray,
+}
+
+# In order: `bool` is a subclass of `int`.
+_SUBCLASS_ENCODERS = [
+    (bool, _encode_bool),
+    ((int, long), _encode_int),
+    (float, _encode_float),
+    (str, _encode_str),
+    (unicode, _encode_unicode),
+    ((list, tuple), _encode_list),
+    (dict, _encode_dict),
+    (numpy.ndarray, _encode_ndarray),
+]
+
+
+def _key_value(o):
+    """Converts objects that `_encode` doesn't know about into values that it
+    does know about.
+
+    Raises `NotCachable` for anything else, so that the memoized function is
+    called without the cache.
+    """
+    from _stbt.match import _ImagePyramid, _Template, MatchParameters
+    if isinstance(o, ImageLogger):
+        if o.enabled:
+            raise NotCachable()
+        return None
+    elif isinstance(o, (_ImagePyramid, _Template)):
+        # Derived from the image that it is passed alongside, which is
+        # hashed separately.
+        return None
+    elif isinstance(o, LooseVersion):
+        return str(o)
+    elif isinstance(o, set):
+        return sorted(o)
+    elif isinstance(o, MatchParameters):
+        return {
+            "match_method": o.match_method.value,
+            "match_threshold": o.match_threshold,
+            "confirm_method": o.confirm_method.value,
+            "confirm_threshold": o.confirm_threshold,
+            "erode_passes": o.erode_passes,
+            "scales": o.scales}
+    else:
+        debug("Image processing cache: %r can't be used as an argument to a "
+              "memoized function; not caching" % (o,))
+        raise NotCachable()
 
 
 def test_that_cache_is_disabled_when_debug_match():
@@ -320,6 +728,242 @@ def test_memoize_iterator_on_empty_iterator():
         assert counter[0] == 1
 
 
+def test_that_cache_hits_use_one_transaction_or_none():
+    class CountingEnvironment(object):
+        def __init__(self, env):
+            self.env = env
+            self.transactions = 0
+
+        def begin(self, *args, **kwargs):
+            self.transactions += 1
+            return self.env.begin(*args, **kwargs)
+
+    @memoize()
+    def cached_function(arg):
+        return arg
+
+    @memoize_iterator()
+    def cached_iterator(arg):
+        for x in range(arg):
+            yield x
+
+    with named_temporary_directory() as tmpdir, cache(tmpdir):
+        assert cached_function(1) == 1
+        assert list(cached_iterator(10)) == range(10)
+        _cache.flush()
+        # The first cache hit reads from LMDB and keeps the result in memory:
+        assert cached_function(1) == 1
+        assert list(cached_iterator(10)) == range(10)
+
+        env = _cache.env = CountingEnvironment(_cache.env)
+        assert cached_function(1) == 1
+        assert list(cached_iterator(10)) == range(10)
+        assert env.transactions == 0
+
+        # Not in memory (e.g. written by a previous run):
+        _cache._recent = _cache._new_recent()  # pylint:disable=protected-access
+        assert cached_function(1) == 1
+        assert env.transactions == 1
+        assert list(cached_iterator(10)) == range(10)
+        assert env.transactions == 2
+        _cache.env = env.env
+
+
+def test_cached_value_formats():
+    from collections import OrderedDict
+
+    hocr = u"<span class='ocrx_word' title='bbox 1 2 3 4'>\xa3</span>" * 1000
+    for value in [None, u"text", [True, [1, 2], None, 0.5, u"\xa3"], hocr,
+                  OrderedDict([("a", 1)])]:
+        assert _loads(_dumps(value)) == value
+
+    assert _dumps(u"text")[:1] == _MARSHAL
+    assert _dumps(hocr)[:1] == _MARSHAL_ZLIB
+    assert len(_dumps(hocr)) < len(json.dumps(hocr)) / 10
+    # `marshal` doesn't support subclasses of the built-in types:
+    assert _dumps(OrderedDict([("a", 1)])) == _JSON + b'{"a": 1}'
+
+
+def test_arg_binder():
+    import pytest
+
+    def f(a, b, c=3, d=None):  # pylint:disable=unused-argument
+        pass
+
+    bind = _arg_binder(f)
+    for args, kwargs in [((1, 2), {}),
+                         ((1, 2, 4), {}),
+                         ((1,), {"b": 2, "d": 5}),
+                         ((), {"a": 1, "b": 2, "c": 4, "d": 5})]:
+        assert bind(*args, **kwargs) == inspect.getcallargs(f, *args, **kwargs)
+
+    for args, kwargs in [((1,), {}),
+                         ((1, 2, 3, 4, 5), {}),
+                         ((1, 2), {"a": 1}),
+                         ((1, 2), {"e": 1})]:
+        with pytest.raises(TypeError):
+            bind(*args, **kwargs)
+
+
+def test_cache_hash_performance():
+    import timeit
+    from _stbt.match import MatchParameters
+
+    frame = numpy.random.randint(0, 256, (720, 1280, 3)).astype(numpy.uint8)
+    template = numpy.zeros((30, 100, 3), dtype=numpy.uint8)
+    match_parameters = MatchParameters()
+
+    def f(image, template, match_parameters, imglog, image_pyramid=None):  # pylint:disable=unused-argument
+        pass
+
+    func_key = json.dumps(["f", None])
+    bind = _arg_binder(f)
+
+    def key(image):
+        return _cache_hash((func_key, bind(
+            image, template, match_parameters, ImageLogger("match"))))
+
+    def hash_frame():
+        from _stbt.xxhash import Xxhash64
+        h = Xxhash64()
+        h.update(frame.data)
+        return h.digest()
+
+    assert key(frame) == key(frame.copy())
+    assert key(frame) != key(frame[:, :, ::-1])
+    assert key(template) != key(template[:, :, :2])
+
+    hash_time = min(timeit.repeat(hash_frame, number=10, repeat=10)) / 10
+    frame_time = min(timeit.repeat(lambda: key(frame), number=10,
+                                   repeat=10)) / 10
+    small_time = min(timeit.repeat(lambda: key(template), number=100,
+                                   repeat=10)) / 100
+    print "Hashing 720p frame: %.0fus, key with 720p frame: %.0fus, " \
+        "key with small image: %.0fus" % (
+            hash_time * 1e6, frame_time * 1e6, small_time * 1e6)
+    # The time is dominated by hashing the pixels of the frame:
+    assert frame_time < hash_time * 2
+    assert small_time < hash_time / 2
+
+
+def test_cache_hash_of_subclasses_of_builtin_types():
+    from collections import namedtuple, OrderedDict
+    import pytest
+
+    Point = namedtuple("Point", "x y")
+    assert _cache_hash(numpy.float64(0.5)) == _cache_hash(0.5)
+    assert _cache_hash(Point(1, 2)) == _cache_hash((1, 2))
+    assert _cache_hash([Point(1, 2)]) == _cache_hash([[1, 2]])
+    assert _cache_hash(OrderedDict([("a", 1)])) == _cache_hash({"a": 1})
+    assert _cache_hash(True) != _cache_hash(1)
+    with pytest.raises(NotCachable):
+        _cache_hash(object())
+
+    # Memoized functions with other arguments aren't cached:
+    counter = [0]
+
+    @memoize()
+    def f(x):  # pylint:disable=unused-argument
+        counter[0] += 1
+        return counter[0]
+
+    with named_temporary_directory() as tmpdir, cache(tmpdir):
+        assert f(Point(1, 2)) == 1
+        assert f((1, 2)) == 1
+        assert f(object()) == 2
+        assert f(object()) == 3
+
+
+def test_that_cache_evicts_least_recently_used_results():
+    import random
+
+    counter = [0]
+
+    def value(arg):
+        # About 5kB that doesn't compress well
+        r = random.Random(arg)
+        return [r.random() for _ in range(600)]
+
+    @memoize()
+    def cached_function(arg):
+        counter[0] += 1
+        return value(arg)
+
+    with named_temporary_directory() as tmpdir:
+        with cache(tmpdir, max_size_mb=0.5):
+            for x in range(200):
+                assert cached_function(x) == value(x)
+                # Keep reading the first result, so it isn't evicted:
+                assert cached_function(0) == value(0)
+            assert counter[0] == 200
+            assert _cache.size() <= 0.5 * 1024 * 1024
+
+            counter[0] = 0
+            assert cached_function(0) == value(0)
+            assert cached_function(199) == value(199)
+            assert counter[0] == 0
+            assert cached_function(1) == value(1)
+            assert counter[0] == 1
+
+        # The limit applies when we open an existing cache too, and it
+        # remembers the access times from the previous run:
+        with cache(tmpdir, max_size_mb=0.1):
+            assert _cache.size() <= 0.1 * 1024 * 1024
+            counter[0] = 0
+            assert cached_function(0) == value(0)
+            assert cached_function(1) == value(1)
+            assert cached_function(199) == value(199)
+            assert counter[0] == 0
+            assert cached_function(150) == value(150)
+            assert counter[0] == 1
+
+
+def test_that_cache_can_be_shared_by_several_processes():
+    import multiprocessing
+    import random
+
+    def value(arg):
+        r = random.Random(arg)
+        return [r.random() for _ in range(600)]
+
+    counter = [0]
+
+    @memoize()
+    def cached_function(arg):
+        counter[0] += 1
+        return value(arg)
+
+    def worker(tmpdir, seed):
+        r = random.Random(seed)
+        with cache(tmpdir, max_size_mb=1):
+            for _ in range(500):
+                x = r.randint(0, 1000)
+                assert cached_function(x) == value(x)
+
+    with named_temporary_directory() as tmpdir:
+        processes = [
+            multiprocessing.Process(target=worker, args=(tmpdir, n))
+            for n in range(8)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        assert [p.exitcode for p in processes] == [0] * len(processes)
+
+        with cache(tmpdir, max_size_mb=1):
+            assert _cache.size() <= 1024 * 1024
+
+        # The workers' results (the ones that haven't been evicted) are
+        # served from the cache, and aren't corrupted. We use a bigger cache
+        # here so that our own cache misses don't evict them before we get to
+        # them.
+        counter[0] = 0
+        with cache(tmpdir, max_size_mb=100):
+            for x in range(1000):
+                assert cached_function(x) == value(x)
+        assert counter[0] <= 950
+
+
 def test_that_cache_speeds_up_match():
     import stbt
     black = numpy.zeros((1440, 2560, 3), dtype=numpy.uint8)
@@ -355,6 +999,34 @@ def test_that_cache_speeds_up_match_all():
                    ['match', 'region', 'first_pass_result', 'frame', 'image'])
 
 
+def test_that_cached_match_doesnt_do_any_image_processing(monkeypatch):
+    import stbt
+    import cv2
+    import _stbt.match
+
+    frame = cv2.imread('tests/buttons.png')
+    match_parameters = stbt.MatchParameters(scales=(0.5, 1.0))
+
+    def match_all():
+        return list(stbt.match_all('tests/button.png', frame=frame,
+                                   match_parameters=match_parameters))
+
+    def fail(*_args, **_kwargs):
+        assert False, "Cache miss"
+
+    with named_temporary_directory() as tmpdir, cache(tmpdir):
+        uncached_result = match_all()
+        monkeypatch.setattr(_stbt.match, "_find_matches", fail)
+        monkeypatch.setattr(_stbt.match._Template, "scaled", fail)  # pylint:disable=protected-access
+        cached_result = match_all()
+
+    assert len(uncached_result) == 6
+    for cached, uncached in itertools.izip_longest(cached_result,
+                                                   uncached_result):
+        _fields_eq(cached, uncached,
+                   ['match', 'region', 'first_pass_result', 'frame', 'image'])
+
+
 def test_that_cache_speeds_up_ocr():
     import stbt
     import cv2
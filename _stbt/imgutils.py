@@ -1,12 +1,15 @@
 import inspect
+import math
 import os
 from collections import namedtuple
 
 import cv2
 import numpy
 
+from .config import get_config
 from .logging import ddebug, debug, warn
 from .types import Region
+from .utils import LRUCache
 
 
 class Frame(numpy.ndarray):
@@ -47,6 +50,124 @@ class Frame(numpy.ndarray):
             dimensions)
 
 
+def _frame_cache(frame):
+    """A dict for caching values computed from `frame` (such as its image
+    pyramid), so that they can be re-used by subsequent operations on the same
+    frame. The cache is discarded with the frame.
+
+    Returns None if `frame` can't be cached: We only cache read-only `Frame`s
+    (such as the frames returned by `stbt.get_frame` and `stbt.frames`)
+    because the user could modify the pixels of any other image. Views onto a
+    frame (such as `crop`) don't share the frame's cache.
+    """
+    if not isinstance(frame, Frame) or frame.flags.writeable:
+        return None
+    return frame.__dict__.setdefault("_cache", {})
+
+
+def _cvt_color(frame, code, region=None):
+    """Like ``cv2.cvtColor(crop(frame, region), code)``.
+
+    For frames that can be cached (see `_frame_cache`) we convert the whole
+    frame and cache it, so that it can be re-used by other operations on the
+    same frame (for example `is_screen_black`, `detect_motion` and `match`
+    all need the grayscale frame). In that case the returned image is
+    read-only, so make a copy if you need to modify it.
+    """
+    cache = _frame_cache(frame)
+    if cache is None:
+        if region is not None:
+            frame = crop(frame, region)
+        return cv2.cvtColor(frame, code)
+    key = ("cvtColor", code)
+    converted = cache.get(key)
+    if converted is None:
+        converted = cv2.cvtColor(frame, code)
+        converted.flags.writeable = False
+        converted = cache.setdefault(key, converted)
+    if region is not None:
+        converted = crop(converted, region)
+    return converted
+
+
+def _low_res_gray(frame, region, shape=None):
+    """Grayscale ``crop(frame, region)``, possibly at a lower resolution, for
+    analysis that doesn't need full resolution (like `detect_motion` and
+    `is_screen_black`).
+
+    If the source pipeline provides a low-resolution grayscale version of the
+    frame (see ``gray_stream_scale`` in stbt.conf) we use that; otherwise we
+    convert the full-resolution frame.
+
+    :param shape: The ``(height, width)`` of the whole grayscale frame to use,
+        for consistency with a previous frame. If the frame doesn't have a
+        low-resolution version of this size (for example because the source
+        pipeline dropped it) we resize the full-resolution frame.
+
+    :returns: A tuple ``(image, gray_region, shape)``: The grayscale image,
+        the region of the grayscale frame that it came from (that is,
+        `region` scaled to the grayscale frame), and the shape of the whole
+        grayscale frame.
+    """
+    stream = _gray_stream_frame(frame)
+    if shape is None:
+        shape = (stream.shape[:2] if stream is not None
+                 else tuple(frame.shape[:2]))
+    gray_region = _scale_region(region, frame.shape, shape)
+    if stream is not None and stream.shape[:2] == shape:
+        return crop(stream, gray_region), gray_region, shape
+    if shape == frame.shape[:2]:
+        return _cvt_color(frame, cv2.COLOR_BGR2GRAY, region), region, shape
+
+    cache = _frame_cache(frame)
+    key = ("low_res_gray", shape)
+    gray = cache.get(key) if cache is not None else None
+    if gray is None:
+        gray = cv2.resize(_cvt_color(frame, cv2.COLOR_BGR2GRAY),
+                          (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+        if cache is not None:
+            gray.flags.writeable = False
+            cache[key] = gray
+    return crop(gray, gray_region), gray_region, shape
+
+
+def _gray_stream_frame(frame):
+    """The frame's low-resolution grayscale version from the source pipeline
+    (see `Display`), or None.
+    """
+    stream = getattr(frame, "_gray_stream", None)
+    stream = stream and stream()
+    if stream is None:
+        return None
+    return stream.get_gray_frame(frame.time)
+
+
+def _scale_region(region, from_shape, to_shape):
+    """Scales `region` of an image with dimensions `from_shape` to an image
+    with dimensions `to_shape`, rounding outwards.
+    """
+    if tuple(from_shape[:2]) == tuple(to_shape[:2]):
+        return region
+    sy = float(to_shape[0]) / from_shape[0]
+    sx = float(to_shape[1]) / from_shape[1]
+    return Region.intersect(
+        Region.from_extents(
+            int(region.x * sx), int(region.y * sy),
+            int(math.ceil(region.right * sx)),
+            int(math.ceil(region.bottom * sy))),
+        Region(0, 0, to_shape[1], to_shape[0]))
+
+
+def _resize_mask(mask, region, gray_region):
+    """Resizes `mask` (a black & white image for `region` of a frame) to match
+    `gray_region` (the same region, as returned by `_low_res_gray`).
+    """
+    if mask is None or gray_region == region:
+        return mask
+    return cv2.resize(mask, (gray_region.width, gray_region.height),
+                      interpolation=cv2.INTER_NEAREST)
+
+
 def _frame_repr(frame):
     if frame is None:
         return "None"
@@ -87,7 +208,17 @@ def _image_region(image):
 
 class _ImageFromUser(namedtuple(
         '_ImageFromUser',
-        'image relative_filename absolute_filename')):
+        'image relative_filename absolute_filename cache')):
+    """An image given to us by the user, either as a filename or as a numpy
+    array.
+
+    `cache` is a dict for caching values derived from the image (like
+    `_frame_cache`) if the image was loaded from disk by `_load_image`;
+    otherwise it is None.
+    """
+    def __new__(cls, image, relative_filename, absolute_filename, cache=None):
+        return super(_ImageFromUser, cls).__new__(
+            cls, image, relative_filename, absolute_filename, cache)
 
     @property
     def friendly_name(self):
@@ -106,11 +237,48 @@ def _load_image(image, flags=None):
         absolute_filename = find_user_file(relative_filename)
         if not absolute_filename:
             raise IOError("No such file: %s" % relative_filename)
-        numpy_image = imread(absolute_filename, flags)
+        numpy_image, cache = _imread_cached(absolute_filename, flags)
         if numpy_image is None:
             raise IOError("Failed to load image: %s" %
                           absolute_filename)
-        return _ImageFromUser(numpy_image, relative_filename, absolute_filename)
+        return _ImageFromUser(numpy_image, relative_filename, absolute_filename,
+                              cache)
+
+
+# Reference images loaded by `_load_image`, keyed by (absolute filename, mtime,
+# flags). The values are (read-only image, dict of derived values). We assume
+# that the derived values take up twice the size of the image.
+_image_cache = LRUCache(0, sizeof=lambda value: 3 * value[0].nbytes)
+
+
+def _imread_cached(filename, flags=None):
+    """Like `imread`, but caches the decoded images in memory so that
+    functions like `wait_for_match` don't have to re-read the same file for
+    every frame.
+
+    Returns a tuple of (image, cache). The image is read-only because it is
+    shared by all the callers. `cache` is a dict for caching values derived from
+    the image (such as its image pyramid). The size of the cache is limited by
+    ``image_cache_size_mb`` in the ``[match]`` section of :ref:`.stbt.conf`.
+    """
+    _image_cache.max_size = int(
+        get_config("match", "image_cache_size_mb", type_=float) * 1024 * 1024)
+    try:
+        key = (filename, os.stat(filename).st_mtime, flags)
+    except OSError:
+        return imread(filename, flags), None
+    value = _image_cache.get(key)
+    if value is None:
+        image = imread(filename, flags)
+        if image is None:
+            return None, None
+        image.flags.writeable = False
+        value = (image, {})
+        _image_cache[key] = value
+        ddebug("Loaded %s (image cache: %d hits, %d misses, %d bytes)" % (
+            filename, _image_cache.hits, _image_cache.misses,
+            _image_cache.size))
+    return value
 
 
 def imread(filename, flags=None):
@@ -220,6 +388,7 @@ def find_user_file(filename):
     #   we're outside of the _stbt directory.
 
     _stbt_dir = os.path.abspath(os.path.dirname(__file__))
+    caller_dirs = []
     caller = inspect.currentframe()
     try:
         # Skip this frame and the parent:
@@ -227,13 +396,10 @@ def find_user_file(filename):
         caller = caller.f_back
         while caller:
             caller_dir = os.path.abspath(
-                os.path.dirname(inspect.getframeinfo(caller).filename))
-            if not caller_dir.startswith(_stbt_dir):
-                caller_path = os.path.join(caller_dir, filename)
-                if os.path.isfile(caller_path):
-                    ddebug("Resolved relative path %r to %r" % (
-                        filename, caller_path))
-                    return caller_path
+                os.path.dirname(caller.f_code.co_filename))
+            if (not caller_dir.startswith(_stbt_dir) and
+                    caller_dir not in caller_dirs):
+                caller_dirs.append(caller_dir)
             caller = caller.f_back
     finally:
         # Avoid circular references between stack frame objects and themselves
@@ -242,6 +408,33 @@ def find_user_file(filename):
         # for more information.
         del caller
 
+    # Searching the filesystem is slow so we remember the result, as functions
+    # like `wait_for_match` look up the same file for every frame. We re-use
+    # the remembered result as long as the file still exists (we don't notice
+    # if a file with the same name is created in a directory that has a higher
+    # precedence in the search).
+    key = (filename, tuple(caller_dirs), os.getcwd())
+    path = _find_user_file_cache.get(key)
+    if path is not None and os.path.isfile(path):
+        return path
+
+    path = _find_user_file(filename, caller_dirs)
+    if path is not None:
+        _find_user_file_cache[key] = path
+    return path
+
+
+_find_user_file_cache = LRUCache(1000)
+
+
+def _find_user_file(filename, caller_dirs):
+    for caller_dir in caller_dirs:
+        caller_path = os.path.join(caller_dir, filename)
+        if os.path.isfile(caller_path):
+            ddebug("Resolved relative path %r to %r" % (
+                filename, caller_path))
+            return caller_path
+
     # Fall back to image from cwd, to allow loading an image saved previously
     # during the same test-run.
     if os.path.isfile(filename):
@@ -9,9 +9,13 @@ https://github.com/stb-tester/stb-tester/blob/master/LICENSE for details).
 """
 
 import enum
+import functools
 import itertools
+import math
+import multiprocessing
 import os
-from collections import namedtuple
+import threading
+from collections import Counter, namedtuple
 
 import cv2
 import numpy
@@ -19,10 +23,12 @@ import numpy
 from . import cv2_compat
 from .config import ConfigurationError, get_config
 from .imgproc_cache import memoize_iterator
-from .imgutils import _frame_repr, _image_region, _load_image, crop, limit_time
+from .imgutils import (_cvt_color, _frame_cache, _frame_repr, _image_region,
+                       _load_image, crop, limit_time)
 from .logging import ddebug, debug, draw_on, get_debug_level, ImageLogger
-from .sqdiff import sqdiff
+from .sqdiff import sqdiff, sqdiff_heatmap
 from .types import Region, UITestFailure
+from .utils import LRUCache
 
 
 class MatchMethod(enum.Enum):
@@ -128,11 +134,23 @@ class MatchParameters(object):
       to account for noise and slight rendering differences. Useful values are
       1 (the default) and 0 (to disable this step).
 
+    :type scales: Sequence[float]
+    :param scales:
+      Factors by which to resize the reference image before searching for it.
+      For example, use ``scales=(1.0, 1.5)`` to find a reference image that
+      you captured from a 720p device in 1080p video. We search at each scale
+      in turn (sharing the video-frame's image pyramid between the searches)
+      and we use the results from the first scale that matches. The resized
+      reference images are cached, so they are only calculated once. Defaults
+      to ``(1.0,)``. In :ref:`.stbt.conf` this is a comma-separated list.
+
+      Added in v31.
+
     """
 
     def __init__(self, match_method=None, match_threshold=None,
                  confirm_method=None, confirm_threshold=None,
-                 erode_passes=None):
+                 erode_passes=None, scales=None):
 
         if match_method is None:
             match_method = get_config(
@@ -148,6 +166,8 @@ class MatchParameters(object):
                 'match', 'confirm_threshold', type_=float)
         if erode_passes is None:
             erode_passes = get_config('match', 'erode_passes', type_=int)
+        if scales is None:
+            scales = get_config('match', 'scales').split(",")
 
         match_method = MatchMethod(match_method)
         confirm_method = ConfirmMethod(confirm_method)
@@ -157,13 +177,19 @@ class MatchParameters(object):
         self.confirm_method = confirm_method
         self.confirm_threshold = confirm_threshold
         self.erode_passes = erode_passes
+        self.scales = tuple(float(x) for x in scales)
+        if not self.scales or any(x <= 0 for x in self.scales):
+            raise ValueError("Invalid scales %r: Scale factors must be "
+                             "greater than 0" % (scales,))
 
     def __repr__(self):
         return (
             "MatchParameters(match_method=%r, match_threshold=%r, "
-            "confirm_method=%r, confirm_threshold=%r, erode_passes=%r)"
+            "confirm_method=%r, confirm_threshold=%r, erode_passes=%r, "
+            "scales=%r)"
             % (self.match_method, self.match_threshold,
-               self.confirm_method, self.confirm_threshold, self.erode_passes))
+               self.confirm_method, self.confirm_threshold, self.erode_passes,
+               self.scales))
 
 
 class Position(namedtuple('Position', 'x y')):
@@ -201,7 +227,8 @@ class MatchResult(object):
 
     def __init__(
             self, time, match, region,  # pylint: disable=redefined-outer-name
-            first_pass_result, frame, image, _first_pass_matched=None):
+            first_pass_result, frame, image, _first_pass_matched=None,
+            _first_pass_level=None):
         self.time = time
         self.match = match
         self.region = region
@@ -209,6 +236,7 @@ class MatchResult(object):
         self.frame = frame
         self.image = image
         self._first_pass_matched = _first_pass_matched
+        self._first_pass_level = _first_pass_level
 
     def __repr__(self):
         return (
@@ -270,14 +298,134 @@ def match(image, frame=None, match_parameters=None, region=Region.ALL):
     Added in v30: Support transparency in the reference image, and new match
     method ``MatchMethod.SQDIFF``.
     """
-    result = next(_match_all(image, frame, match_parameters, region))
+    return _match(image, frame, match_parameters, region)
+
+
+def match_many(images, frame=None, match_parameters=None, region=Region.ALL):
+    """
+    Search for several images in a single video frame.
+
+    This gives the same results as calling `match` once for each image, but
+    it is faster because the video frame is only pre-processed once and that
+    work is shared by all the searches. This is useful in a `FrameObject`
+    property that checks for one of many different reference images.
+
+    :param images:
+      A list (or other iterable) of images to search for. Each image can be
+      anything that `match` accepts as its ``image`` parameter.
+
+    The other parameters are the same as `match`. The same ``frame``,
+    ``match_parameters`` and ``region`` are used for every image.
+
+    :returns:
+      A list of `MatchResult` objects, one for each image in ``images`` (in
+      the same order).
+
+    Example:
+
+    .. code-block:: python
+
+        results = stbt.match_many(["play.png", "pause.png"], frame=frame)
+        playing, paused = [bool(x) for x in results]
+
+    Added in v31.
+    """
+    if frame is None:
+        import stbt
+        frame = stbt.get_frame()
+
+    image_pyramids = _frame_pyramids(frame)
+    return [_match(image, frame, match_parameters, region, image_pyramids)
+            for image in images]
+
+
+def _match(image, frame, match_parameters, region, image_pyramids=None,
+           hint=None, probe=False, stats=None):
+    """Like `match`.
+
+    `hint` is an optional `Region` where the image is likely to be (typically
+    the region of a previous match). We search a small area around `hint`
+    first, and we only search the whole `region` if that doesn't match.
+
+    If `probe` is True we check the top level of the image pyramid (see
+    `_probe_match`) before doing the full search.
+
+    `stats` is an optional `collections.Counter` that counts where the search
+    stopped, including the pyramid level at which the first pass rejected the
+    frame (for `wait_for_match`'s debug output).
+    """
+    if stats is None:
+        stats = Counter()
+
+    if (hint is not None or probe) and frame is None:
+        import stbt
+        frame = stbt.get_frame()
+    if probe and image_pyramids is None:
+        # So that the full search can re-use the probe's results.
+        image_pyramids = _frame_pyramids(frame)
+
+    if hint is not None:
+        result = _match_near_hint(image, frame, match_parameters, region,
+                                  image_pyramids, hint)
+        if result is not None:
+            debug("Match found near %r: %s" % (hint, str(result)))
+            stats["matched near previous match"] += 1
+            return result
+
+    if probe:
+        result = _probe_match(image, frame, match_parameters, region,
+                              image_pyramids)
+        if result is not None:
+            debug("No match found. Closest match: %s" % str(result))
+            stats["rejected by first pass at level %d"
+                  % result._first_pass_level] += 1  # pylint:disable=protected-access
+            return result
+
+    result = next(_match_all(image, frame, match_parameters, region,
+                             image_pyramids))
     if result.match:
         debug("Match found: %s" % str(result))
+        stats["matched"] += 1
     else:
         debug("No match found. Closest match: %s" % str(result))
+        if result._first_pass_matched:  # pylint:disable=protected-access
+            stats["rejected by second pass"] += 1
+        else:
+            stats["rejected by first pass at level %d"
+                  % result._first_pass_level] += 1  # pylint:disable=protected-access
     return result
 
 
+# How far (in pixels) from `hint` to search in `_match_near_hint`.
+_HINT_MARGIN = 16
+
+
+def _match_near_hint(image, frame, match_parameters, region, image_pyramids,
+                     hint):
+    """Returns a truthy `MatchResult` if `image` matches near `hint`, otherwise
+    None.
+    """
+    search_region = Region.intersect(_image_region(frame), region)
+    if search_region is None or not search_region.contains(hint):
+        return None
+    window = Region.intersect(
+        search_region,
+        hint.extend(x=-_HINT_MARGIN, y=-_HINT_MARGIN,
+                    right=_HINT_MARGIN, bottom=_HINT_MARGIN))
+    try:
+        result = next(_match_all(image, frame, match_parameters, window,
+                                 image_pyramids, draw=False))
+    except ValueError:
+        # The window is too small for the reference image (at any of
+        # `match_parameters.scales`), so `hint` can't be where it is now.
+        return None
+    if result.match:
+        draw_on(frame, result, label="match(%r)" %
+                os.path.basename(_load_image(image).friendly_name))
+        return result
+    return None
+
+
 def match_all(image, frame=None, match_parameters=None, region=Region.ALL):
     """
     Search for all instances of an image in a single video frame.
@@ -312,10 +460,18 @@ def match_all(image, frame=None, match_parameters=None, region=Region.ALL):
             break
 
 
-def _match_all(image, frame, match_parameters, region):
+def _match_all(image, frame, match_parameters, region, image_pyramids=None,
+               draw=True):
     """
     Generator that yields a sequence of zero or more truthy MatchResults,
     followed by a falsey MatchResult.
+
+    If `draw` is False the results aren't drawn on the output video.
+
+    `image_pyramids` is an optional dict used to share the frame's image
+    pyramid between several calls that search the same frame (see
+    `match_many`). It is keyed by the region of the frame that was searched.
+    Defaults to the frame's own cache (see `_frame_pyramids`).
     """
     if match_parameters is None:
         match_parameters = MatchParameters()
@@ -324,6 +480,45 @@ def _match_all(image, frame, match_parameters, region):
         import stbt
         frame = stbt.get_frame()
 
+    template, frame, input_region, image_pyramid, prepared_template = \
+        _prepare_match(image, frame, match_parameters, region, image_pyramids)
+
+    imglog = ImageLogger(
+        "match", match_parameters=match_parameters,
+        template_name=template.friendly_name,
+        input_region=input_region)
+
+    # pylint:disable=undefined-loop-variable
+    try:
+        for (matched, match_region, first_pass_matched, first_pass_certainty,
+             first_pass_level) in _find_scaled_matches(
+                image_pyramid.image, prepared_template.image,
+                match_parameters, imglog, image_pyramid, prepared_template):
+
+            result = _match_result(
+                template, frame, input_region, matched, match_region,
+                first_pass_matched, first_pass_certainty, first_pass_level)
+            imglog.append(matches=result)
+            if draw:
+                draw_on(frame, result, label="match(%r)" %
+                        os.path.basename(template.friendly_name))
+            yield result
+
+    finally:
+        try:
+            _log_match_image_debug(imglog)
+        except Exception:  # pylint:disable=broad-except
+            pass
+
+
+def _prepare_match(image, frame, match_parameters, region, image_pyramids):
+    """Validates the arguments to `_match_all` and loads & prepares the
+    reference image and the frame's image pyramid.
+
+    Returns a tuple of `(template, frame, input_region, image_pyramid,
+    prepared_template)`, where `frame` is a view of the original frame with
+    shape (h, w, channels).
+    """
     template = _load_image(image)
 
     # Normalise single channel images to shape (h, w, 1) rather than just (h, w)
@@ -331,6 +526,10 @@ def _match_all(image, frame, match_parameters, region):
     if len(t.shape) == 2:
         t.shape = t.shape + (1,)
 
+    if image_pyramids is None:
+        image_pyramids = _frame_pyramids(frame)
+    original_frame = frame
+
     frame = frame.view()
     if len(frame.shape) == 2:
         frame.shape = frame.shape + (1,)
@@ -350,7 +549,9 @@ def _match_all(image, frame, match_parameters, region):
         raise ValueError("Expected 3-channel image, got %d channels: %s"
                          % (t.shape[2], template.absolute_filename))
 
-    if any(frame.shape[x] < t.shape[x] for x in (0, 1)):
+    scaled_shapes = [_scaled_shape(t.shape, x)
+                     for x in match_parameters.scales]
+    if not any(_fits(shape, frame.shape) for shape in scaled_shapes):
         raise ValueError("Frame %r must be larger than reference image %r"
                          % (frame.shape, t.shape))
     if any(t.shape[x] < 1 for x in (0, 1)):
@@ -382,38 +583,105 @@ def _match_all(image, frame, match_parameters, region):
     if input_region is None:
         raise ValueError("frame with dimensions %r doesn't contain %r"
                          % (frame.shape, region))
-    if input_region.height < t.shape[0] or input_region.width < t.shape[1]:
+    input_shape = (input_region.height, input_region.width)
+    if not any(_fits(shape, input_shape) for shape in scaled_shapes):
         raise ValueError("%r must be larger than reference image %r"
                          % (input_region, t.shape))
 
-    imglog = ImageLogger(
-        "match", match_parameters=match_parameters,
-        template_name=template.friendly_name,
-        input_region=input_region)
+    image_pyramid = image_pyramids.get(input_region)
+    if image_pyramid is None:
+        image_pyramid = _ImagePyramid(crop(frame, input_region))
+        if frame.shape[2] == 3 and _frame_cache(original_frame) is not None:
+            image_pyramid.gray = functools.partial(
+                _cvt_color, original_frame, cv2.COLOR_BGR2GRAY, input_region)
+        image_pyramids[input_region] = image_pyramid
 
-    # pylint:disable=undefined-loop-variable
-    try:
-        for (matched, match_region, first_pass_matched,
-             first_pass_certainty) in _find_matches(
-                crop(frame, input_region), t, match_parameters, imglog):
-
-            match_region = Region.from_extents(*match_region) \
-                                 .translate(input_region.x, input_region.y)
-            result = MatchResult(
-                getattr(frame, "time", None), matched, match_region,
-                first_pass_certainty, frame,
-                (template.relative_filename or template.image),
-                first_pass_matched)
-            imglog.append(matches=result)
-            draw_on(frame, result, label="match(%r)" %
-                    os.path.basename(template.friendly_name))
-            yield result
+    if template.cache is None:
+        prepared_template = _Template(t)
+    else:
+        prepared_template = template.cache.get("match_template")
+        if prepared_template is None:
+            prepared_template = template.cache.setdefault(
+                "match_template", _Template(t))
 
-    finally:
-        try:
-            _log_match_image_debug(imglog)
-        except Exception:  # pylint:disable=broad-except
-            pass
+    return template, frame, input_region, image_pyramid, prepared_template
+
+
+def _scaled_shape(shape, scale):
+    return (max(1, int(round(shape[0] * scale))),
+            max(1, int(round(shape[1] * scale)))) + tuple(shape[2:])
+
+
+def _fits(shape, container_shape):
+    return shape[0] <= container_shape[0] and shape[1] <= container_shape[1]
+
+
+def _scaled_templates(prepared_template, scales, image_shape):
+    """Yields `prepared_template` resized to each of `scales` (in order) at
+    which it fits inside an image of shape `image_shape`.
+
+    This is a generator so that we don't resize the reference image until we
+    need it (for example, we don't need it if the results are in the
+    `imgproc_cache`).
+    """
+    for scale in scales:
+        if _fits(_scaled_shape(prepared_template.image.shape, scale),
+                 image_shape):
+            yield prepared_template.scaled(scale)
+
+
+def _match_result(template, frame, input_region, matched, match_region,
+                  first_pass_matched, first_pass_certainty, first_pass_level):
+    match_region = Region.from_extents(*match_region) \
+                         .translate(input_region.x, input_region.y)
+    return MatchResult(
+        getattr(frame, "time", None), matched, match_region,
+        first_pass_certainty, frame,
+        (template.relative_filename or template.image),
+        first_pass_matched, first_pass_level)
+
+
+def _probe_match(image, frame, match_parameters, region, image_pyramids=None):
+    """Searches only the top (smallest) level of the image pyramid.
+
+    Returns a falsey `MatchResult` if the image isn't at that level, otherwise
+    None (so you have to do a full search with `_match_all`). Unlike
+    `_match_all` this doesn't write debug images, so don't use it if image
+    debugging is enabled (debug level 2). The top-level heatmaps are kept in
+    the image pyramid, so the full search doesn't calculate them again (see
+    `_ImagePyramid.top_level_heatmaps`).
+
+    With `MatchMethod.SQDIFF`, if `_sqdiff_lower_bound` shows that the image
+    can't be anywhere in the frame we return without calculating the
+    heatmap, so the result's ``region`` is only an approximation of the
+    nearest match, and ``first_pass_result`` is an upper bound of its
+    certainty. Otherwise the result is the same as `_match_all`'s.
+    """
+    if match_parameters is None:
+        match_parameters = MatchParameters()
+
+    template, frame, input_region, image_pyramid, prepared_template = \
+        _prepare_match(image, frame, match_parameters, region, image_pyramids)
+
+    result = None
+    for scaled in _scaled_templates(prepared_template, match_parameters.scales,
+                                    image_pyramid.image.shape):
+        _, matched, match_region, certainty, level = next(
+            _find_candidate_matches(
+                image_pyramid.image, scaled.image, match_parameters,
+                ImageLogger("match"), image_pyramid, scaled,
+                top_level_only=True),
+            (None, True, None, None, None))
+        if matched:
+            return None
+        if result is None or certainty > result.first_pass_result:
+            result = _match_result(template, frame, input_region, False,
+                                   list(match_region), False, certainty,
+                                   level)
+
+    draw_on(frame, result, label="match(%r)" %
+            os.path.basename(template.friendly_name))
+    return result
 
 
 def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
@@ -456,9 +724,29 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
     last_pos = Position(0, 0)
     image = _load_image(image)
     debug("Searching for " + image.friendly_name)
+
+    # The image is usually where we last saw it, so we search there first.
+    # Remembered across calls (e.g. from `press_until_match`) for images loaded
+    # from disk.
+    hint_key = _hint_key(image, match_parameters, region)
+    if hint_key is None:
+        hint = None
+    else:
+        hint = _last_match_regions.get(hint_key)
+
+    # Most frames don't match, and usually we can tell that from the smallest
+    # level of the image pyramid. We can't take this shortcut if we are saving
+    # debug images because it skips the image-debug logging.
+    probe = get_debug_level() <= 1
+    stats = Counter()
+
     for frame in frames:
-        res = match(image, match_parameters=match_parameters,
-                    region=region, frame=frame)
+        res = _match(image, frame, match_parameters, region, hint=hint,
+                     probe=probe, stats=stats)
+        if res.match:
+            hint = res.region
+            if hint_key is not None:
+                _last_match_regions[hint_key] = hint
         if res.match and (match_count == 0 or res.position == last_pos):
             match_count += 1
         else:
@@ -466,11 +754,42 @@ def wait_for_match(image, timeout_secs=10, consecutive_matches=1,
         last_pos = res.position
         if match_count == consecutive_matches:
             debug("Matched " + image.friendly_name)
+            _log_wait_for_match_stats(image, stats)
             return res
 
+    _log_wait_for_match_stats(image, stats)
     raise MatchTimeout(res.frame, image.friendly_name, timeout_secs)  # pylint:disable=undefined-loop-variable
 
 
+def _log_wait_for_match_stats(image, stats):
+    debug("wait_for_match: Searched %d frames for %s: %s" % (
+        sum(stats.values()), image.friendly_name,
+        ", ".join("%s: %d" % x for x in sorted(stats.items()))))
+
+
+# Regions where `wait_for_match` last found each reference image, keyed by
+# `_hint_key`.
+_last_match_regions = LRUCache(32)
+
+
+def _hint_key(image, match_parameters, region):
+    """The key for `_last_match_regions`, or None if we can't remember where
+    we found `image` (because it wasn't loaded from disk).
+
+    The key includes everything that affects where (and at what size) we can
+    find the image, so a region found with different `scales`, or with an
+    older version of the file, isn't re-used.
+    """
+    if image.absolute_filename is None:
+        return None
+    try:
+        mtime = os.stat(image.absolute_filename).st_mtime
+    except OSError:
+        return None
+    return (image.absolute_filename, mtime, image.image.shape,
+            match_parameters.scales, region)
+
+
 class MatchTimeout(UITestFailure):
     """Exception raised by `wait_for_match`.
 
@@ -493,46 +812,127 @@ class MatchTimeout(UITestFailure):
             self.expected, self.timeout_secs)
 
 
-@memoize_iterator({"version": "30"})
-def _find_matches(image, template, match_parameters, imglog):
+@memoize_iterator({"version": "31.1"})
+def _find_scaled_matches(image, template, match_parameters, imglog,
+                         image_pyramid=None, prepared_template=None):
+    """The cached entry point of our image-matching algorithm.
+
+    Searches for `template` within `image` at each of
+    `match_parameters.scales` (using `_find_matches`). Yields the same tuples
+    as `_find_matches`, from the first scale where `template` matches; if it
+    doesn't match at any scale, yields the nearest match from any scale.
+
+    The cache key is the hash of `image` (the region of the frame that we
+    are searching), the original (unscaled) `template` and
+    `match_parameters`. When the results are in the cache we don't resize the
+    reference image or do any other image processing. The position of the
+    region within the frame isn't part of the key because the results are
+    relative to `image`.
+
+    The debug images of the first scale that we search have the usual names;
+    the names of the other scales' images start with "scale1-", "scale2-",
+    etc. (see `_PrefixedImageLogger`).
+    """
+    if prepared_template is None:
+        prepared_template = _Template(template)
+
+    nearest, nearest_certainty = None, None
+    for i, scaled in enumerate(_scaled_templates(
+            prepared_template, match_parameters.scales, image.shape)):
+        if i > 0:
+            scale_imglog = _PrefixedImageLogger(imglog, "scale%d-" % i)
+        else:
+            scale_imglog = imglog
+        any_matches = False
+        for result in _find_matches(image, scaled.image, match_parameters,
+                                    scale_imglog, image_pyramid, scaled):
+            matched, _, _, certainty, _ = result
+            if matched or any_matches:
+                any_matches = True
+                yield result
+            elif nearest is None or certainty > nearest_certainty:
+                nearest, nearest_certainty = result, certainty
+        if any_matches:
+            return
+    yield nearest
+
+
+class _PrefixedImageLogger(object):
+    """Wraps an `ImageLogger`, adding `prefix` to the names of the images and
+    data that are logged through it. `ImageLogger` doesn't allow logging the
+    same name twice, so this is used for each of `MatchParameters.scales`
+    after the first.
+    """
+    def __init__(self, imglog, prefix):
+        self.imglog = imglog
+        self.prefix = prefix
+        self.enabled = imglog.enabled
+
+    def imwrite(self, name, image, *args, **kwargs):
+        self.imglog.imwrite(self.prefix + name, image, *args, **kwargs)
+
+    def set(self, **kwargs):
+        self.imglog.set(**{self.prefix + k: v for k, v in kwargs.items()})
+
+    def append(self, **kwargs):
+        self.imglog.append(**{self.prefix + k: v for k, v in kwargs.items()})
+
+
+def _find_matches(image, template, match_parameters, imglog,
+                  image_pyramid=None, prepared_template=None):
     """Our image-matching algorithm.
 
     Runs 2 passes: `_find_candidate_matches` to locate potential matches, then
     `_confirm_match` to discard false positives from the first pass.
 
-    Returns an iterator yielding zero or more `(True, position, certainty)`
-    tuples for each location where `template` is found within `image`, followed
-    by a single `(False, position, certainty)` tuple when there are no further
-    matching locations.
+    Returns an iterator yielding zero or more `(True, region,
+    first_pass_matched, first_pass_certainty, first_pass_level)` tuples for
+    each location where `template` is found within `image`, followed by a
+    single tuple starting with `False` when there are no further matching
+    locations. `first_pass_level` is the pyramid level where the first pass
+    stopped (0 unless the first pass rejected the match at a smaller level).
+
+    `image_pyramid` is an optional `_ImagePyramid` of `image`, to avoid
+    re-calculating it when searching the same image for several templates.
+    Similarly `prepared_template` is an optional `_Template` of `template`.
     """
 
-    if template.shape[2] == 4:
-        # Normalise transparency channel to either 0 or 255
-        mask = template[:, :, 3]
-        mask[mask < 255] = 0
+    if prepared_template is None:
+        prepared_template = _Template(template)
+    template = prepared_template.image
+
+    confirmer = _Confirmer(image, prepared_template, match_parameters,
+                           image_pyramid)
 
     # pylint:disable=undefined-loop-variable
-    for i, first_pass_matched, region, first_pass_certainty in \
-            _find_candidate_matches(image, template, match_parameters, imglog):
+    for (i, first_pass_matched, region, first_pass_certainty,
+         first_pass_level) in _find_candidate_matches(
+            image, template, match_parameters, imglog, image_pyramid,
+            prepared_template):
         confirmed = (
             first_pass_matched and
-            _confirm_match(image, region, template, match_parameters,
-                           imwrite=lambda name, img: imglog.imwrite(
-                               "match%d-%s" % (i, name), img)))  # pylint:disable=cell-var-from-loop
+            confirmer.confirm(region, imwrite=lambda name, img: imglog.imwrite(
+                "match%d-%s" % (i, name), img)))  # pylint:disable=cell-var-from-loop
 
         yield (confirmed, list(region), first_pass_matched,
-               first_pass_certainty)
+               first_pass_certainty, first_pass_level)
         if not confirmed:
             break
 
 
-def _find_candidate_matches(image, template, match_parameters, imglog):
+def _find_candidate_matches(image, template, match_parameters, imglog,
+                            image_pyramid=None, prepared_template=None,
+                            top_level_only=False):
     """First pass: Search for `template` in the entire `image`.
 
     This searches the entire image, so speed is more important than accuracy.
     False positives are ok; we apply a second pass later (`_confirm_match`) to
     weed out false positives.
 
+    If `top_level_only` is True, we stop after the top (smallest) level of
+    the pyramid if it matches, without yielding anything. If it doesn't match
+    we may report an approximate nearest match (see `_probe_match`).
+
     http://docs.opencv.org/modules/imgproc/doc/object_detection.html
     http://opencv-code.com/tutorials/fast-template-matching-with-image-pyramid
     """
@@ -568,20 +968,25 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
         else:
             certainty = 1 - float(s) / (n * 255 * 255)
         yield (0, certainty >= match_parameters.match_threshold,
-               _image_region(image), certainty)
-        yield (0, False, _image_region(image), 0.)
+               _image_region(image), certainty, 0)
+        yield (0, False, _image_region(image), 0., 0)
         return
 
-    if template.shape[2] == 4:
-        # OpenCV wants mask to match template's number of channels
-        mask = cv2.cvtColor(template[:, :, 3], cv2.COLOR_GRAY2BGR)
-        template = template[:, :, 0:3]
+    if prepared_template is None:
+        prepared_template = _Template(template)
+    template = prepared_template.pyramid.image
+    template_pyramid = prepared_template.pyramid.levels(levels)
+    if prepared_template.mask_pyramid is None:
+        mask_pyramid = [None] * len(template_pyramid)
     else:
-        mask = None
-
-    template_pyramid = _build_pyramid(template, levels)
-    mask_pyramid = _build_pyramid(mask, len(template_pyramid), is_mask=True)
-    image_pyramid = _build_pyramid(image, len(template_pyramid))
+        mask_pyramid = prepared_template.mask_pyramid.levels(
+            len(template_pyramid))
+    if image_pyramid is None:
+        image_pyramid = _ImagePyramid(image)
+    integrals = image_pyramid.integral
+    top_level_heatmaps = image_pyramid.top_level_heatmaps
+    image_pyramid = image_pyramid.levels(len(template_pyramid))
+    top_level = len(template_pyramid) - 1
     roi_mask = None  # Initial region of interest: The whole image.
 
     for level in reversed(range(len(template_pyramid))):
@@ -591,13 +996,6 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
             else:
                 roi_mask = cv2.pyrUp(roi_mask)
 
-        def imwrite(name, img, scale=1):
-            imglog.imwrite("level%d-%s" % (level, name), img, scale=scale)  # pylint:disable=cell-var-from-loop
-
-        heatmap, heatmap_scale = _match_template(
-            image_pyramid[level], template_pyramid[level], mask_pyramid[level],
-            method, roi_mask, level, imwrite)
-
         # Relax the threshold slightly for scaled-down pyramid levels to
         # compensate for scaling artifacts.
         if level == 0:
@@ -608,6 +1006,41 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
             relax = 0.2
         threshold = max(0, match_parameters.match_threshold - relax)
 
+        def imwrite(name, img, scale=1):
+            imglog.imwrite("level%d-%s" % (level, name), img, scale=scale)  # pylint:disable=cell-var-from-loop
+
+        heatmap = None
+        heatmap_key = (prepared_template, method, threshold, level)
+        if level == top_level and not imglog.enabled:
+            # Calculated by `_probe_match` (if it found a potential match):
+            heatmap, heatmap_scale = top_level_heatmaps.pop(
+                heatmap_key, (None, None))
+
+        if (heatmap is None and roi_mask is None and
+                method == cv2.TM_SQDIFF and mask_pyramid[level] is None and
+                image_pyramid[level].shape[0] * image_pyramid[level].shape[1]
+                <= _SQDIFF_LOWER_BOUND_MAX_IMAGE_PX):
+            bound = _sqdiff_lower_bound(integrals(level),
+                                        template_pyramid[level])
+            if top_level_only:
+                # We're only checking whether the image could be here, so if
+                # it can't, we don't need to find the exact nearest match.
+                matched, best_match_position, certainty = \
+                    _find_best_match_position(
+                        bound, template_pyramid[level].size * (255 ** 2),
+                        threshold, level)
+                if not matched:
+                    heatmap, heatmap_scale = None, 1
+                    break
+            roi_mask = _sqdiff_roi_mask(
+                bound, image_pyramid[level], template_pyramid[level],
+                threshold)
+
+        if heatmap is None:
+            heatmap, heatmap_scale = _match_template(
+                image_pyramid[level], template_pyramid[level],
+                mask_pyramid[level], method, roi_mask, level, imwrite)
+
         matched, best_match_position, certainty = _find_best_match_position(
             heatmap, heatmap_scale, threshold, level)
         imglog.append(pyramid_levels=(
@@ -615,6 +1048,9 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
 
         if not matched:
             break
+        if top_level_only:
+            top_level_heatmaps[heatmap_key] = (heatmap, heatmap_scale)
+            return
 
         if level > 0 or imglog.enabled:
             _, roi_mask = cv2.threshold(
@@ -629,10 +1065,11 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
     region = Region(*_upsample(best_match_position, level),
                     width=template.shape[1], height=template.shape[0])
 
+    candidates = None
     for i in itertools.count():
 
         imglog.imwrite("match%d-heatmap" % i, heatmap, scale=heatmap_scale)
-        yield (i, matched, region, certainty)
+        yield (i, matched, region, certainty, level)
         if not matched:
             return
         assert level == 0
@@ -648,8 +1085,14 @@ def _find_candidate_matches(image, template, match_parameters, imglog):
             heatmap_scale,
             cv2_compat.FILLED)
 
-        matched, best_match_position, certainty = _find_best_match_position(
-            heatmap, heatmap_scale, threshold, level)
+        # Instead of searching the whole heatmap again for each match (with
+        # `_find_best_match_position`), we find all the positions above the
+        # threshold once, and sort them from best to worst.
+        if candidates is None:
+            candidates = _find_candidate_positions(
+                heatmap, heatmap_scale, threshold)
+        matched, best_match_position, certainty = _next_match_position(
+            candidates, heatmap, heatmap_scale, threshold, level)
         region = Region(*best_match_position,
                         width=template.shape[1], height=template.shape[0])
 
@@ -697,16 +1140,50 @@ def _match_template(image, template, mask, method, roi_mask, level, imwrite):
         kwargs = {"mask": mask}
     else:
         kwargs = {}  # For OpenCV < 3.0.0
-    for roi in rois:
+
+    if _use_sqdiff_heatmap(image, template, mask, method):
+        # For small templates (typically at the top of the pyramid) a direct
+        # sliding-window sum is faster than OpenCV's FFT-based implementation.
+        ddebug("Level %d: Using sqdiff_heatmap" % level)
+        if mask is None:
+            c_template, c_scale = template, 1.
+        else:
+            # Same scaling as OpenCV's masked SQDIFF (see comment below).
+            c_template = numpy.dstack([template, mask[:, :, 0]])
+            c_scale = 1. / 255 ** 2
+    else:
+        c_template, c_scale = None, None
+
+    def match_roi(roi, out=None):
         r = roi.extend(right=template.shape[1] - 1,
                        bottom=template.shape[0] - 1)
-        ddebug("Level %d: Searching in %s" % (level, roi))
-        cv2.matchTemplate(
-            image[r.to_slice()],
-            template,
-            method,
-            matches_heatmap[roi.to_slice()],
-            **kwargs)
+        if c_template is not None:
+            if out is None:
+                out = numpy.empty((roi.height, roi.width),
+                                  dtype=numpy.float32)
+            try:
+                sqdiff_heatmap(c_template, image[r.to_slice()], out, c_scale)
+                return out
+            except NotImplementedError as e:
+                ddebug("Level %d: sqdiff_heatmap missed fast-path: %s" % (
+                    level, e))
+        return cv2.matchTemplate(image[r.to_slice()], template, method,
+                                 out, **kwargs)
+
+    pool = _thread_pool() if len(rois) > 1 else None
+    if pool is None:
+        for roi in rois:
+            ddebug("Level %d: Searching in %s" % (level, roi))
+            match_roi(roi, matches_heatmap[roi.to_slice()])
+    else:
+        # OpenCV releases the GIL so we can search the ROIs concurrently. Each
+        # ROI's result goes into its own array & is copied into the heatmap
+        # afterwards, in order, so that the result doesn't depend on the order
+        # in which the threads finish (ROIs can overlap).
+        ddebug("Level %d: Searching in %d ROIs: %s" % (
+            level, len(rois), rois))
+        for roi, heatmap in zip(rois, pool.map(match_roi, rois)):
+            matches_heatmap[roi.to_slice()] = heatmap
 
     if method == cv2.TM_SQDIFF:
         # OpenCV's SQDIFF_NORMED normalises by the pixel intensity across
@@ -736,6 +1213,121 @@ def _match_template(image, template, mask, method, roi_mask, level, imwrite):
     return matches_heatmap, scale
 
 
+# Calculating `_sqdiff_lower_bound` takes about 1/4 of the time of
+# `cv2.matchTemplate`, so we only do it for the (small) top level of the
+# pyramid. It isn't worth it at the lower levels anyway because the regions
+# of interest only contain positions that were close to matching at the
+# previous level.
+_SQDIFF_LOWER_BOUND_MAX_IMAGE_PX = 320 * 180
+
+
+def _sqdiff_lower_bound(integral, template):
+    """A lower bound of the (unmasked) TM_SQDIFF heatmap of `template`
+    against an image, calculated from the image's integral images (see
+    `_ImagePyramid.integral`) without looking at the pixels of the image.
+
+    For each channel, the sum of squared differences between the template
+    `t` and the window `i` of the image is at least:
+
+    * ``(|t| - |i|)**2`` (by the triangle inequality), where ``|x|`` is the
+      Euclidean norm (the square root of the sum of squares); and
+    * ``(sum(t) - sum(i))**2 / n`` (by the Cauchy-Schwarz inequality), where
+      ``n`` is the number of pixels in the template.
+    """
+    h, w = template.shape[:2]
+    t = template.reshape(h * w, -1).astype(numpy.float64)
+    channels = t.shape[1]
+
+    def scalar(x):
+        return tuple(x) + (0,) * (4 - channels)
+
+    # Window sums (`s`) and sums of squares (`sq`) of each channel of the
+    # image, for each position of the template. We use OpenCV's arithmetic
+    # functions rather than numpy's because this needs to be much faster than
+    # `cv2.matchTemplate` to be worth doing.
+    s, sq = [cv2.subtract(cv2.add(ii[h:, w:], ii[:-h, :-w]),
+                          cv2.add(ii[:-h, w:], ii[h:, :-w]))
+             for ii in integral]
+
+    sq = cv2.subtract(cv2.sqrt(sq), scalar(numpy.sqrt((t ** 2).sum(axis=0))))
+    sq = cv2.multiply(sq, sq)
+    s = cv2.subtract(s, scalar(t.sum(axis=0)))
+    s = cv2.multiply(s, s, scale=1. / (h * w))
+    bound = cv2.max(sq, s)
+    if channels > 1:
+        bound = cv2.transform(bound, numpy.ones((1, channels)))
+    return bound.reshape(bound.shape[:2])
+
+
+def _sqdiff_roi_mask(bound, image, template, threshold):
+    """Region-of-interest mask (for `_match_template`) that excludes the
+    positions that `bound` (see `_sqdiff_lower_bound`) proves can't match.
+
+    We also keep any position that could be the best (if not matching)
+    position, so that we report the same result for negative matches. We
+    find out how good the best position is by calculating the exact value at
+    the position with the lowest bound, which is usually close to the best.
+
+    Returns None if most of the positions can't be excluded: Then it's faster
+    to search the whole image than the individual regions of interest.
+    """
+    h, w = template.shape[:2]
+    y, x = numpy.unravel_index(numpy.argmin(bound), bound.shape)
+    best = cv2.norm(template, image[y:y + h, x:x + w], cv2.NORM_L2SQR)
+    scale = template.size * (255 ** 2)
+    # Allow for rounding errors in `cv2.matchTemplate`'s results:
+    limit = max((1 - threshold) * scale, best) + scale * 1e-5
+    candidates = bound <= limit
+    if numpy.count_nonzero(candidates) > candidates.size // 2:
+        return None
+    roi_mask = numpy.zeros(bound.shape, dtype=numpy.uint8)
+    roi_mask[candidates] = 255
+    return roi_mask
+
+
+# Largest template (in pixels) for which `sqdiff_heatmap` is faster than
+# `cv2.matchTemplate`. Above this, OpenCV's FFT wins regardless of the size of
+# the frame. Measured on x86-64 with OpenCV 3.4.
+_SQDIFF_HEATMAP_MAX_TEMPLATE_PX = 150
+_SQDIFF_HEATMAP_MAX_MASKED_TEMPLATE_PX = 64
+
+
+def _use_sqdiff_heatmap(image, template, mask, method):
+    if method != cv2.TM_SQDIFF or image.ndim != 3 or image.shape[2] != 3:
+        return False
+    if image.strides[1:] != (3, 1) or not 0 < image.strides[0] <= 0xffff:
+        return False
+    if mask is None:
+        max_px = _SQDIFF_HEATMAP_MAX_TEMPLATE_PX
+    else:
+        max_px = _SQDIFF_HEATMAP_MAX_MASKED_TEMPLATE_PX
+    return template.shape[0] * template.shape[1] <= max_px
+
+
+_thread_pools = {}
+
+
+def _thread_pool():
+    """Returns a thread pool for `_match_template`, with the number of threads
+    configured by ``threads`` in the ``[match]`` section of :ref:`.stbt.conf`;
+    or None if it is configured to use a single thread.
+    """
+    threads = get_config("match", "threads", type_=int)
+    if threads <= 0:
+        threads = multiprocessing.cpu_count()
+    if threads == 1:
+        return None
+    # The pool's worker threads don't survive `fork`, so a child process
+    # (e.g. from `stbt auto-selftest`) would wait forever for a pool that it
+    # inherited from its parent. Each process gets its own pool instead.
+    key = (os.getpid(), threads)
+    try:
+        return _thread_pools[key]
+    except KeyError:
+        from multiprocessing.pool import ThreadPool
+        return _thread_pools.setdefault(key, ThreadPool(threads))
+
+
 def _find_best_match_position(matches_heatmap, scale, threshold, level):
     min_value, _, min_location, _ = cv2.minMaxLoc(matches_heatmap)
     min_value /= scale
@@ -748,6 +1340,39 @@ def _find_best_match_position(matches_heatmap, scale, threshold, level):
     return (matched, best_match_position, certainty)
 
 
+def _find_candidate_positions(matches_heatmap, scale, threshold):
+    """Returns an iterator of `(x, y, value)` for all the positions in
+    `matches_heatmap` that are above `threshold`, from best to worst.
+
+    Positions with the same value are in raster order, which is the same
+    order in which `cv2.minMaxLoc` would find them.
+    """
+    certainty = 1 - matches_heatmap.astype(numpy.float64) / scale
+    ys, xs = numpy.nonzero(certainty >= threshold)
+    values = matches_heatmap[ys, xs]
+    order = numpy.argsort(values, kind="mergesort")
+    return itertools.izip(xs[order].tolist(), ys[order].tolist(),
+                          values[order])
+
+
+def _next_match_position(candidates, matches_heatmap, scale, threshold,
+                         level):
+    """Like `_find_best_match_position`, but only looks at the `candidates`
+    from `_find_candidate_positions`.
+
+    Positions that have been excluded from `matches_heatmap` (because they
+    overlap a previous match) since `candidates` was created are skipped.
+    """
+    for x, y, value in candidates:
+        if matches_heatmap[y, x] == value:
+            certainty = 1 - float(value) / scale
+            best_match_position = Position(x, y)
+            ddebug("Level %d: Matched at %s with certainty %s" % (
+                level, best_match_position, certainty))
+            return (True, best_match_position, certainty)
+    return _find_best_match_position(matches_heatmap, scale, threshold, level)
+
+
 def _build_pyramid(image, levels, is_mask=False):
     """A "pyramid" is [an image, the same image at 1/2 the size, at 1/4, ...]
 
@@ -762,15 +1387,169 @@ def _build_pyramid(image, levels, is_mask=False):
     """
     if image is None:
         return [None] * levels
-    pyramid = [image]
-    for _ in range(levels - 1):
-        if any(x < 20 for x in pyramid[-1].shape[:2]):
-            break
-        downsampled = cv2.pyrDown(pyramid[-1])
-        if is_mask:
-            cv2.threshold(downsampled, 254, 255, cv2.THRESH_BINARY, downsampled)
-        pyramid.append(downsampled)
-    return pyramid
+    return _ImagePyramid(image, is_mask).levels(levels)
+
+
+class _Template(object):
+    """A reference image, prepared for `_find_matches`.
+
+    The transparency channel (if any) is normalised to either 0 or 255, and it
+    is split out into a separate mask because OpenCV wants the mask to have the
+    same number of channels as the template. The pyramids are built lazily.
+
+    For reference images loaded from disk this is cached alongside the image
+    (see `_imread_cached`), so it is re-used by subsequent searches.
+    """
+    def __init__(self, template):
+        if template.shape[2] == 4:
+            # Normalise transparency channel to either 0 or 255
+            template = template.copy()
+            mask = template[:, :, 3]
+            mask[mask < 255] = 0
+            self.pyramid = _ImagePyramid(template[:, :, 0:3])
+            self.mask_pyramid = _ImagePyramid(
+                cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR), is_mask=True)
+        else:
+            self.pyramid = _ImagePyramid(template)
+            self.mask_pyramid = None
+        self.image = template
+        self._confirm_images = {}
+        self._scaled = {1.0: self}
+
+    def scaled(self, scale):
+        """The reference image resized by `scale`, as a `_Template`.
+
+        Scales of 1/2, 1/4, etc. re-use the levels of our own pyramid. The
+        result is cached so that it is only calculated once per reference
+        image.
+        """
+        try:
+            return self._scaled[scale]
+        except KeyError:
+            pass
+        level = int(round(-math.log(scale, 2)))
+        if (level > 0 and scale == 0.5 ** level and
+                len(self.pyramid.levels(level + 1)) == level + 1):
+            image = self.pyramid.levels(level + 1)[level]
+            if self.mask_pyramid is not None:
+                mask = self.mask_pyramid.levels(level + 1)[level]
+                image = numpy.dstack([image, mask[:, :, 0]])
+        else:
+            h, w = _scaled_shape(self.image.shape, scale)[:2]
+            image = cv2.resize(
+                self.image, (w, h),
+                interpolation=cv2.INTER_AREA if scale < 1 else
+                cv2.INTER_LINEAR)
+        if len(image.shape) == 2:
+            image = image.reshape(image.shape + (1,))
+        return self._scaled.setdefault(scale, _Template(image))
+
+    def confirm_images(self, normed):
+        """The reference image pre-processed for `_Confirmer`.
+
+        Returns a tuple of (mask, grayscale, normalised, masked) images. The
+        normalised image is None unless `normed` is True; the mask and the
+        masked image are None unless the reference image has transparency.
+        """
+        try:
+            return self._confirm_images[normed]
+        except KeyError:
+            pass
+        template = self.pyramid.image
+        if self.image.shape[2] == 4:
+            # Create transparency mask from alpha channel
+            mask = numpy.ascontiguousarray(self.image[:, :, 3])
+        else:
+            mask = None
+        if template.shape[2] == 3:
+            gray = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = template
+        if normed:
+            normalized = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX,
+                                       mask=mask)
+        else:
+            normalized = None
+        if mask is None:
+            masked = None
+        else:
+            masked = cv2.bitwise_and(
+                normalized if normed else gray, mask)
+        return self._confirm_images.setdefault(
+            normed, (mask, gray, normalized, masked))
+
+
+class _ImagePyramid(object):
+    """An image and its pyramid (see `_build_pyramid`).
+
+    The smaller levels are only calculated when they are first needed, and
+    then they are re-used by subsequent calls to `levels`. This allows sharing
+    the pyramid of a video-frame between searches for several templates (which
+    may need a different number of levels, depending on the template size).
+    """
+    def __init__(self, image, is_mask=False):
+        self.image = image
+        self.is_mask = is_mask
+        # Optional function that returns `image` converted to grayscale, from
+        # the video-frame's cache (see `_cvt_color`):
+        self.gray = None
+        self._pyramid = [image]
+        self._integrals = {}
+        # Heatmaps of the top pyramid level that `_probe_match` found a
+        # potential match in, for the full search to re-use. Keyed by
+        # (`_Template`, cv2 match method, threshold, level):
+        self.top_level_heatmaps = {}
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def levels(self, n):
+        """Returns (up to) the first `n` levels of the pyramid."""
+        with self._lock:
+            while len(self._pyramid) < n and not self._complete:
+                if any(x < 20 for x in self._pyramid[-1].shape[:2]):
+                    self._complete = True
+                    break
+                downsampled = cv2.pyrDown(self._pyramid[-1])
+                if self.is_mask:
+                    cv2.threshold(downsampled, 254, 255, cv2.THRESH_BINARY,
+                                  downsampled)
+                self._pyramid.append(downsampled)
+            return self._pyramid[:n]
+
+    def integral(self, level):
+        """Returns the integral images (the sum and the sum of squares, see
+        `cv2.integral2`) of the specified level of the pyramid.
+        """
+        with self._lock:
+            try:
+                return self._integrals[level]
+            except KeyError:
+                image = self._pyramid[level]
+        integral = cv2.integral2(image, sdepth=cv2.CV_64F,
+                                 sqdepth=cv2.CV_64F)
+        with self._lock:
+            return self._integrals.setdefault(level, integral)
+
+
+# Maximum number of regions per frame to keep the image pyramids of. Each
+# pyramid needs about 1/3 of the size of the region for its smaller levels.
+_FRAME_PYRAMID_CACHE_SIZE = 4
+
+
+def _frame_pyramids(frame):
+    """Returns a dict-like cache of `_ImagePyramid`s of `frame`, keyed by the
+    region of the frame. The pyramids are cached on read-only `Frame`s (see
+    `_frame_cache`) so that repeated searches of the same frame (for example
+    by several `FrameObject` properties) don't have to re-calculate them.
+    """
+    cache = _frame_cache(frame)
+    if cache is None:
+        return {}
+    try:
+        return cache["match_pyramids"]
+    except KeyError:
+        return cache.setdefault("match_pyramids",
+                                LRUCache(_FRAME_PYRAMID_CACHE_SIZE))
 
 
 def _upsample(position, levels):
@@ -787,58 +1566,94 @@ class _Size(namedtuple("_Size", "h w")):
     pass
 
 
-def _confirm_match(image, region, template, match_parameters, imwrite):
+class _Confirmer(object):
     """Second pass: Confirm that `template` matches `image` at `region`.
 
     This only checks `template` at a single position within `image`, so we can
     afford to do more computationally-intensive checks than
     `_find_candidate_matches`.
-    """
-
-    if match_parameters.confirm_method == ConfirmMethod.NONE:
-        return True
 
-    if template.shape[2] == 4:
-        # Create transparency mask from alpha channel
-        mask = template[:, :, 3]
-        template = template[:, :, 0:3]
-    else:
-        mask = None
-
-    # Set Region Of Interest to the "best match" location
-    image = image[region.y:region.bottom, region.x:region.right]
-    imwrite("confirm-source_roi", image)
-    if image.shape[2] == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-    imwrite("confirm-source_roi_gray", image)
-    imwrite("confirm-template_gray", template)
-
-    if match_parameters.confirm_method == ConfirmMethod.NORMED_ABSDIFF:
-        cv2.normalize(image, image, 0, 255, cv2.NORM_MINMAX, mask=mask)
-        cv2.normalize(template, template, 0, 255, cv2.NORM_MINMAX, mask=mask)
-        imwrite("confirm-source_roi_gray_normalized", image)
-        imwrite("confirm-template_gray_normalized", template)
+    `match_all` confirms many candidate regions of the same image, so the
+    reference image is pre-processed once (see `_Template.confirm_images`),
+    the image is converted to grayscale once (if there is more than one
+    candidate, or if the video-frame's cached grayscale image is available via
+    `image_pyramid`) and the intermediate images are written into buffers that
+    are re-used for each candidate.
+    """
+    def __init__(self, image, prepared_template, match_parameters,
+                 image_pyramid=None):
+        self.image = image
+        self.template = prepared_template
+        self.match_parameters = match_parameters
+        self.image_pyramid = image_pyramid
+        self._gray_image = None
+        self._count = 0
+        self._buffers = None
+
+    def confirm(self, region, imwrite):
+        if self.match_parameters.confirm_method == ConfirmMethod.NONE:
+            return True
+
+        normed = (self.match_parameters.confirm_method ==
+                  ConfirmMethod.NORMED_ABSDIFF)
+        mask, template_gray, template_normalized, template_masked = \
+            self.template.confirm_images(normed)
+        if self._buffers is None:
+            self._buffers = [numpy.empty(template_gray.shape[:2], numpy.uint8)
+                             for _ in range(4)]
+        normalized, masked, absdiff, thresholded = self._buffers
+
+        # Set Region Of Interest to the "best match" location
+        image = self.image[region.y:region.bottom, region.x:region.right]
+        imwrite("confirm-source_roi", image)
+        if image.shape[2] == 3:
+            image = self._gray_roi(region, image)
+        imwrite("confirm-source_roi_gray", image)
+        imwrite("confirm-template_gray", template_gray)
+        template = template_gray
+
+        if normed:
+            if mask is not None:
+                # `cv2.normalize` only writes the pixels selected by the mask
+                normalized.fill(0)
+            image = cv2.normalize(image, normalized, 0, 255, cv2.NORM_MINMAX,
+                                  mask=mask)
+            template = template_normalized
+            imwrite("confirm-source_roi_gray_normalized", image)
+            imwrite("confirm-template_gray_normalized", template)
 
-    if mask is not None:
-        image = cv2.bitwise_and(image, mask)
-        template = cv2.bitwise_and(template, mask)
-        imwrite("confirm-source_roi_masked", image)
-        imwrite("confirm-template_masked", template)
-
-    absdiff = cv2.absdiff(image, template)
-    _, thresholded = cv2.threshold(
-        absdiff, int((1 - match_parameters.confirm_threshold) * 255),
-        255, cv2.THRESH_BINARY)
-    eroded = cv2.erode(
-        thresholded,
-        cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)),
-        iterations=match_parameters.erode_passes)
-    imwrite("confirm-absdiff", absdiff)
-    imwrite("confirm-absdiff_threshold", thresholded)
-    imwrite("confirm-absdiff_threshold_erode", eroded)
-
-    return cv2.countNonZero(eroded) == 0
+        if mask is not None:
+            image = cv2.bitwise_and(image, mask, dst=masked)
+            template = template_masked
+            imwrite("confirm-source_roi_masked", image)
+            imwrite("confirm-template_masked", template)
+
+        cv2.absdiff(image, template, dst=absdiff)
+        cv2.threshold(
+            absdiff, int((1 - self.match_parameters.confirm_threshold) * 255),
+            255, cv2.THRESH_BINARY, dst=thresholded)
+        eroded = cv2.erode(
+            thresholded,
+            cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)),
+            iterations=self.match_parameters.erode_passes)
+        imwrite("confirm-absdiff", absdiff)
+        imwrite("confirm-absdiff_threshold", thresholded)
+        imwrite("confirm-absdiff_threshold_erode", eroded)
+
+        return cv2.countNonZero(eroded) == 0
+
+    def _gray_roi(self, region, roi):
+        self._count += 1
+        if (self._gray_image is None and self.image_pyramid is not None and
+                self.image_pyramid.gray is not None):
+            self._gray_image = self.image_pyramid.gray()
+        if self._gray_image is None:
+            if self._count == 1:
+                # Converting the whole image isn't worth it for a single
+                # candidate (`match`, as opposed to `match_all`).
+                return cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+            self._gray_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray_image[region.y:region.bottom, region.x:region.right]
 
 
 def _merge_regions(regions):
@@ -864,14 +1679,20 @@ def _log_match_image_debug(imglog):
         imglog.data["template_name"],
         "Matched" if any(imglog.data["matches"]) else "Didn't match")
 
-    for matched, position, _, level in imglog.data.get("pyramid_levels", []):
-        template = imglog.images["level%d-template" % level]
-        imglog.imwrite("level%d-source_with_match" % level,
-                       imglog.images["level%d-source" % level],
-                       Region(x=position.x, y=position.y,
-                              width=template.shape[1],
-                              height=template.shape[0]),
-                       _Annotation.MATCHED if matched else _Annotation.NO_MATCH)
+    # "pyramid_levels" for the first scale, "scale1-pyramid_levels" etc. for
+    # the others (see `_find_scaled_matches`):
+    for key in sorted(imglog.data):
+        if not key.endswith("pyramid_levels"):
+            continue
+        prefix = key[:-len("pyramid_levels")]
+        for matched, position, _, level in imglog.data[key]:
+            name = "%slevel%d-" % (prefix, level)
+            template = imglog.images[name + "template"]
+            imglog.imwrite(
+                name + "source_with_match", imglog.images[name + "source"],
+                Region(x=position.x, y=position.y,
+                       width=template.shape[1], height=template.shape[0]),
+                _Annotation.MATCHED if matched else _Annotation.NO_MATCH)
 
     for i, result in enumerate(imglog.data["matches"]):
         imglog.imwrite(
@@ -6,7 +6,8 @@ import cv2
 
 from .config import ConfigurationError, get_config
 from .imgutils import (_frame_repr, _image_region, _ImageFromUser, _load_image,
-                       pixel_bounding_box, crop, limit_time)
+                       _low_res_gray, _resize_mask, _scale_region,
+                       pixel_bounding_box, limit_time)
 from .logging import debug, draw_on, ImageLogger
 from .types import Region, UITestFailure
 
@@ -89,22 +90,25 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
 
     region = Region.intersect(_image_region(frame), region)
 
-    previous_frame_gray = cv2.cvtColor(crop(frame, region),
-                                       cv2.COLOR_BGR2GRAY)
+    # If the source pipeline provides a low-resolution grayscale stream (see
+    # `gray_stream_scale` in stbt.conf) we look for motion in that, so
+    # `gray_region` and `mask_image` are scaled to match.
+    previous_frame_gray, gray_region, gray_shape = _low_res_gray(frame, region)
     if (mask.image is not None and
-            mask.image.shape[:2] != previous_frame_gray.shape[:2]):
+            mask.image.shape[:2] != (region.height, region.width)):
         raise ValueError(
             "The dimensions of the mask '%s' %s don't match the "
             "video frame %s" % (
                 mask.friendly_name, mask.image.shape,
-                previous_frame_gray.shape))
+                (region.height, region.width)))
+    mask_image = _resize_mask(mask.image, region, gray_region)
 
     for frame in frames:
         imglog = ImageLogger("detect_motion", region=region)
         imglog.imwrite("source", frame)
         imglog.set(roi=region, noise_threshold=noise_threshold)
 
-        frame_gray = cv2.cvtColor(crop(frame, region), cv2.COLOR_BGR2GRAY)
+        frame_gray, _, _ = _low_res_gray(frame, region, gray_shape)
         imglog.imwrite("gray", frame_gray)
         imglog.imwrite("previous_frame_gray", previous_frame_gray)
 
@@ -112,9 +116,9 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
         previous_frame_gray = frame_gray
         imglog.imwrite("absdiff", absdiff)
 
-        if mask.image is not None:
-            absdiff = cv2.bitwise_and(absdiff, mask.image)
-            imglog.imwrite("mask", mask.image)
+        if mask_image is not None:
+            absdiff = cv2.bitwise_and(absdiff, mask_image)
+            imglog.imwrite("mask", mask_image)
             imglog.imwrite("absdiff_masked", absdiff)
 
         _, thresholded = cv2.threshold(
@@ -131,7 +135,8 @@ def detect_motion(timeout_secs=10, noise_threshold=None, mask=None,
             # Undo cv2.erode above:
             out_region = out_region.extend(x=-1, y=-1)
             # Undo crop:
-            out_region = out_region.translate(region.x, region.y)
+            out_region = out_region.translate(gray_region.x, gray_region.y)
+            out_region = _scale_region(out_region, gray_shape, frame.shape)
 
         motion = bool(out_region)
 
@@ -86,6 +86,39 @@ SqdiffResult sqdiff(const uint8_t *t, uint16_t t_stride,
     return out;
 }
 
+/* Sliding-window version of `sqdiff`, like OpenCV's `cv2.matchTemplate` with
+ * `TM_SQDIFF`: For each position (x, y) of template t within frame f, writes
+ * the square difference (multiplied by `scale`) into
+ * out[y * out_stride + x].
+ *
+ * out_width and out_height are the dimensions of the output (the number of
+ * positions to check). The frame must be at least
+ * (out_width + width_px - 1) x (out_height + height_px - 1) pixels.
+ * out_stride is the stride between lines of out, measured in floats.
+ *
+ * This is faster than OpenCV (which uses an FFT) when the template or the
+ * search area is small.
+ */
+void sqdiff_heatmap(const uint8_t *t, uint16_t t_stride,
+                    const uint8_t *f, uint16_t f_stride,
+                    uint16_t width_px, uint16_t height_px,
+                    int color_depth,
+                    float *out, uint32_t out_stride,
+                    uint16_t out_width, uint16_t out_height,
+                    double scale)
+{
+    uint16_t f_bytes_per_px = (color_depth == PIXEL_DEPTH_U8) ? 1 : 3;
+
+    for (uint16_t y = 0; y < out_height; y++) {
+        for (uint16_t x = 0; x < out_width; x++) {
+            SqdiffResult r = sqdiff(
+                t, t_stride, f + y * f_stride + x * f_bytes_per_px, f_stride,
+                width_px, height_px, color_depth);
+            out[y * out_stride + x] = (float) (r.total * scale);
+        }
+    }
+}
+
 static uint32_t sqdiff_U8(const unsigned char* a, const unsigned char* b,
                           uint16_t len)
 {
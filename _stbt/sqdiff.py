@@ -32,6 +32,27 @@ _libstbt.sqdiff.argtypes = [
 ]
 
 
+# void sqdiff_heatmap(const uint8_t *t, uint16_t t_stride,
+#                     const uint8_t *f, uint16_t f_stride,
+#                     uint16_t width_px, uint16_t height_px,
+#                     int color_depth,
+#                     float *out, uint32_t out_stride,
+#                     uint16_t out_width, uint16_t out_height,
+#                     double scale)
+
+_libstbt.sqdiff_heatmap.restype = None
+_libstbt.sqdiff_heatmap.argtypes = [
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
+    ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint16,
+    ctypes.c_uint16, ctypes.c_uint16,
+    ctypes.c_int,
+    ctypes.POINTER(ctypes.c_float), ctypes.c_uint32,
+    ctypes.c_uint16, ctypes.c_uint16,
+    ctypes.c_double,
+]
+
+
+PIXEL_DEPTH_U8 = 0
 PIXEL_DEPTH_BGR = 1
 PIXEL_DEPTH_BGRx = 2
 PIXEL_DEPTH_BGRA = 3
@@ -61,6 +82,8 @@ def _sqdiff_c(template, frame):
             frame.strides[1] != 3:
         raise NotImplementedError("Pixel data must be contiguous")
 
+    _check_row_strides(template, frame)
+
     color_depth = COLOR_DEPTH_LOOKUP[(template.strides[1], template.shape[2])]
 
     t = template.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
@@ -72,6 +95,65 @@ def _sqdiff_c(template, frame):
     return out.total, out.count
 
 
+def sqdiff_heatmap(template, frame, out, scale=1.):
+    """Like ``cv2.matchTemplate(frame, template, cv2.TM_SQDIFF, out)``, but
+    faster for small templates or small frames.
+
+    If `template` has 4 channels the 4th channel is a transparency mask where
+    255 is opaque and anything else is transparent. Transparent pixels are
+    ignored, like ``cv2.matchTemplate``'s ``mask`` parameter (except that
+    OpenCV scales the result by 1/255**2 when using a mask, so pass that as
+    `scale` if you want the same result).
+
+    Raises `NotImplementedError` if the arrays aren't in a supported layout
+    (see `_sqdiff_c`).
+    """
+    if template.dtype != numpy.uint8 or frame.dtype != numpy.uint8:
+        raise NotImplementedError("dtype must be uint8")
+    if out.dtype != numpy.float32 or out.strides[1] != 4:
+        raise NotImplementedError("out must be contiguous float32")
+    _check_row_strides(template, frame)
+    if out.strides[0] <= 0 or out.strides[0] % 4 != 0:
+        raise NotImplementedError(
+            "Unsupported row stride %d for out" % out.strides[0])
+    if out.shape != (frame.shape[0] - template.shape[0] + 1,
+                     frame.shape[1] - template.shape[1] + 1):
+        raise ValueError("Wrong shape %r for output array" % (out.shape,))
+    if frame.shape[2] == 1:
+        if template.shape[2] != 1 or frame.strides[1] != 1 or \
+                template.strides[1] != 1:
+            raise NotImplementedError("Pixel data must be contiguous")
+        color_depth = PIXEL_DEPTH_U8
+    else:
+        if frame.strides[2] != 1 or template.strides[2] != 1 or \
+                frame.strides[1] != 3:
+            raise NotImplementedError("Pixel data must be contiguous")
+        try:
+            color_depth = COLOR_DEPTH_LOOKUP[
+                (template.strides[1], template.shape[2])]
+        except KeyError:
+            raise NotImplementedError(
+                "Unsupported template layout %r" % (template.strides,))
+
+    _libstbt.sqdiff_heatmap(
+        template.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),
+        template.strides[0],
+        frame.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),
+        frame.strides[0],
+        template.shape[1], template.shape[0], color_depth,
+        out.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+        out.strides[0] // 4, out.shape[1], out.shape[0], scale)
+
+
+def _check_row_strides(template, frame):
+    # The C functions take the row strides as `uint16_t`, and they assume that
+    # the rows are in increasing order in memory (so not `frame[::-1]`).
+    for name, a in [("template", template), ("frame", frame)]:
+        if not 0 < a.strides[0] <= 0xffff:
+            raise NotImplementedError(
+                "Unsupported row stride %d for %s" % (a.strides[0], name))
+
+
 def _sqdiff_numpy(template, frame):
     template = template.astype(numpy.int64)
     frame = frame.astype(numpy.int64)
@@ -140,6 +222,48 @@ def test_sqdiff_c_numpy_equivalence():
                     _sqdiff_c(t, frame_cropped))
 
 
+def test_sqdiff_heatmap_matches_opencv():
+    import cv2
+    for _ in range(20):
+        frame, template, template_transparent = _random_template((40, 30))
+        frame = numpy.random.randint(0, 256, (30, 40, 3), dtype=numpy.uint8)
+        shape = (frame.shape[0] - template.shape[0] + 1,
+                 frame.shape[1] - template.shape[1] + 1)
+
+        expected = cv2.matchTemplate(frame, template, cv2.TM_SQDIFF)
+        out = numpy.zeros(shape, dtype=numpy.float32)
+        sqdiff_heatmap(template, frame, out)
+        assert numpy.allclose(expected, out, rtol=1e-5, atol=1e-3)
+
+        mask = cv2.cvtColor(template_transparent[:, :, 3], cv2.COLOR_GRAY2BGR)
+        expected = cv2.matchTemplate(frame, template_transparent[:, :, :3],
+                                     cv2.TM_SQDIFF, mask=mask)
+        sqdiff_heatmap(template_transparent, frame, out, 1. / 255 ** 2)
+        assert numpy.allclose(expected, out, rtol=1e-5, atol=1e-3)
+
+        expected = cv2.matchTemplate(frame[:, :, :1], template[:, :, :1],
+                                     cv2.TM_SQDIFF)
+        sqdiff_heatmap(numpy.ascontiguousarray(template[:, :, :1]),
+                       numpy.ascontiguousarray(frame[:, :, :1]), out)
+        assert numpy.allclose(expected, out, rtol=1e-5, atol=1e-3)
+
+
+def test_sqdiff_heatmap_rejects_unsupported_strides():
+    import pytest
+    frame = numpy.random.randint(0, 256, (30, 40, 3), dtype=numpy.uint8)
+    template = numpy.ascontiguousarray(frame[10:15, 10:20])
+    out = numpy.zeros((26, 31), dtype=numpy.float32)
+    for t, f, o in [(template, frame[::-1], out),
+                    (template[::-1], frame, out),
+                    (template, frame, out[::-1]),
+                    (template, numpy.zeros((30, 0x10000, 3), numpy.uint8)[
+                        :, :40], out)]:
+        with pytest.raises(NotImplementedError):
+            sqdiff_heatmap(t, f, o)
+    with pytest.raises(NotImplementedError):
+        _sqdiff_c(template, frame[::-1][10:15, 10:20])
+
+
 def _make_sqdiff_numba():
     # numba implementation included for the purposes of comparison.
     try:
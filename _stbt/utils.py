@@ -1,6 +1,8 @@
 import errno
 import os
 import tempfile
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 from shutil import rmtree
 
@@ -71,3 +73,85 @@ def find_import_name(filename):
         import_dir, s = os.path.split(import_dir)
         import_name = "%s.%s" % (s, import_name)
     return import_dir, import_name
+
+
+class LRUCache(object):
+    """A dict-like cache that discards the least-recently-used items once the
+    total size of its contents exceeds `max_size`.
+
+    The size of each item is given by `sizeof(value)`; by default every item
+    has a size of 1, so `max_size` is the maximum number of items. `hits` and
+    `misses` count the calls to `get`. It is safe to use from multiple threads.
+    """
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizeof = sizeof or (lambda _: 1)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                return
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+def test_lrucache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b", "missing") == "missing"
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lrucache_max_size_with_sizeof():
+    cache = LRUCache(10, sizeof=len)
+    cache["a"] = "xxxx"
+    cache["b"] = "yyyy"
+    cache["c"] = "zzzz"
+    assert "a" not in cache
+    assert cache.size == 8
+    cache["b"] = "y"
+    assert cache.size == 5
+    cache["d"] = "too big for the cache"
+    assert "d" not in cache
+    assert cache.size == 5
@@ -37,6 +37,7 @@ from _stbt.match import (
     ConfirmMethod,
     match,
     match_all,
+    match_many,
     MatchMethod,
     MatchParameters,
     MatchResult,
@@ -80,6 +81,7 @@ __all__ = [
     "load_image",
     "match",
     "match_all",
+    "match_many",
     "match_text",
     "MatchMethod",
     "MatchParameters",
@@ -247,6 +249,15 @@ def frames(timeout_secs=None):
     :returns:
       An iterator of frames in OpenCV format (`stbt.Frame`).
 
+    By default each iteration gives you the most recent frame, so if your
+    loop takes longer to process each frame than the video's frame interval,
+    some frames will be skipped. To get every frame (for example to measure
+    latency precisely), increase ``frame_buffer_depth`` in the ``[global]``
+    section of :ref:`.stbt.conf`: Then each iteration gives you the next
+    frame from a buffer of recent frames, and frames are only skipped if the
+    buffer overflows. You can also limit the number of frames per second
+    with ``max_analysis_fps`` in the same section.
+
     Changed in v29: Returns ``Iterator[stbt.Frame]`` instead of
     ``Iterator[(stbt.Frame, int)]``. Use the Frame's ``time`` attribute
     instead.
@@ -58,6 +58,8 @@ def main():
                 mp["confirm_threshold"] = float(value)
             elif name == "erode_passes":
                 mp["erode_passes"] = int(value)
+            elif name == "scales":
+                mp["scales"] = value.split(",")
             else:
                 raise Exception("Unknown match_parameter argument '%s'" % p)
     except Exception:  # pylint:disable=broad-except
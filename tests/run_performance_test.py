@@ -1,9 +1,12 @@
 #!/usr/bin/python
 
+import argparse
 import glob
+import multiprocessing
 import os
 import subprocess
 import sys
+import time
 import timeit
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
@@ -13,6 +16,14 @@ sys.path.pop(0)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source-pipeline", action="store_true",
+        help="Also measure the source pipeline's frame rate with different "
+             "`videoconvert_threads` settings. This needs GStreamer and takes "
+             "about 10 seconds per setting.")
+    args = parser.parse_args()
+
     os.chdir(os.path.dirname(__file__))
 
     # Disable cpu frequency scaling
@@ -40,6 +51,75 @@ def main():
                                   max(times),
                                   sum(times) / len(times))
 
+    benchmark_match_threads()
+    if args.source_pipeline:
+        benchmark_source_pipeline_threads()
+
+
+def benchmark_match_threads():
+    """Compare `[match] threads` settings on a case that has several regions
+    of interest in the full-size pyramid level. (In
+    "repeating-pattern-full-frame.png" the regions of interest merge into
+    one, so it doesn't use the thread pool at all.)
+    """
+    from _stbt.config import _config_init
+
+    f = stbt.load_image("buttons.png")
+    t = stbt.load_image("button.png")
+
+    print
+    print "threads,min,avg,max"
+    config = _config_init()
+    original = config.get("match", "threads")
+    try:
+        for threads in sorted({1, 2, 4, multiprocessing.cpu_count()}):
+            config.set("match", "threads", str(threads))
+            times = timeit.repeat(lambda: list(stbt.match_all(t, f)),
+                                  number=1, repeat=20)
+            print "%d,%f,%f,%f" % (threads, min(times),
+                                   sum(times) / len(times), max(times))
+    finally:
+        config.set("match", "threads", original)
+
+
+def benchmark_source_pipeline_threads(duration_secs=10):
+    """Compare `[global] videoconvert_threads` settings: How many frames per
+    second does the source pipeline deliver from a live 1080p60 source?
+
+    The raw frames are I420, like the output of a hardware capture device or
+    a video decoder, so `videoconvert` has to convert every frame to BGR.
+    Frames that arrive while `videoconvert` is busy are dropped by
+    `_stbt_raw_frames_queue`, so anything less than 60 means that the
+    conversion can't keep up.
+    """
+    from _stbt.config import _config_init
+    from _stbt.core import new_device_under_test_from_config
+
+    print
+    print "videoconvert_threads,fps"
+    config = _config_init()
+    keys = ["source_pipeline", "sink_pipeline", "videoconvert_threads"]
+    original = {k: config.get("global", k) for k in keys}
+    try:
+        config.set("global", "source_pipeline",
+                   "videotestsrc is-live=true ! "
+                   "video/x-raw,format=I420,width=1920,height=1080,"
+                   "framerate=60/1")
+        config.set("global", "sink_pipeline", "")
+        for threads in sorted({1, 2, 4, multiprocessing.cpu_count()}):
+            config.set("global", "videoconvert_threads", str(threads))
+            dut = new_device_under_test_from_config()
+            with dut:
+                dut.get_frame()  # Wait for the pipeline to start
+                display = dut._display  # pylint:disable=protected-access
+                start = display.frames_received
+                time.sleep(duration_secs)
+                frames = display.frames_received - start
+            print "%d,%.1f" % (threads, float(frames) / duration_secs)
+    finally:
+        for k, v in original.items():
+            config.set("global", k, v)
+
 
 if __name__ == "__main__":
     main()
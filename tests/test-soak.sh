@@ -48,3 +48,42 @@ test_long_running_stbt_run_process_for_memory_leaks() {
             video/x-raw,format=BGR,width=1280,height=720,framerate=25/1" \
         test.py
 }
+
+test_stbt_run_memory_use_with_sink_pipeline_at_1080p60() {
+    [[ -n "$STBT_RUN_SOAK_TESTS" ]] ||
+        skip "Skipping because \$STBT_RUN_SOAK_TESTS isn't set"
+
+    # The sink pipeline holds on to the most recent frames (see
+    # `sink_buffer_max_mb` in stbt.conf) so this is where high-resolution,
+    # high-frame-rate video uses the most memory. Run with `-v` to see the
+    # steady-state VmRSS.
+    cat > test.py <<-EOF
+	import os, time, stbt
+	
+	def get_rss():
+	    # See http://man7.org/linux/man-pages/man5/proc.5.html
+	    with open("/proc/%s/stat" % os.getpid()) as f:
+	        stat = f.read()
+	    rss = int(stat.split()[23]) * 4
+	    print "VmRSS: %s kB" % rss
+	    return rss
+	
+	# Let the frame buffers fill up first:
+	for frame in stbt.frames(timeout_secs=10):
+	    pass
+	initial_rss = get_rss()
+	
+	end_time = time.time() + 300  # 5 minutes
+	while time.time() < end_time:
+	    stbt.draw_text("VmRSS: %s kB" % get_rss())
+	    for frame in stbt.frames(timeout_secs=10):
+	        pass
+	    assert get_rss() < initial_rss * 1.1
+	EOF
+    stbt run -v \
+        --source-pipeline="videotestsrc is-live=true ! \
+            video/x-raw,format=BGR,width=1920,height=1080,framerate=60/1" \
+        --sink-pipeline="fakesink sync=false" \
+        --save-video=video.webm \
+        test.py
+}
@@ -30,6 +30,18 @@ def test_that_load_image_looks_in_callers_directory():
         stbt.load_image("info2.png")
 
 
+def test_that_load_image_notices_when_file_is_deleted():
+    from _stbt.utils import scoped_curdir
+    with scoped_curdir():
+        with pytest.raises(IOError):
+            stbt.load_image("info2.png")
+        cv2.imwrite("info2.png", numpy.zeros((10, 10, 3), dtype=numpy.uint8))
+        assert stbt.load_image("info2.png").shape == (10, 10, 3)
+        os.remove("info2.png")
+        with pytest.raises(IOError):
+            stbt.load_image("info2.png")
+
+
 def test_load_image_with_unicode_filename():
     print sys.getfilesystemencoding()
     shutil.copyfile(_find_file("Rothlisberger.png"),
@@ -128,6 +140,172 @@ def test_is_screen_black_with_numpy_mask_and_region():
     assert not stbt.is_screen_black(frame, mask, 20, region)
 
 
+def test_is_screen_black_with_read_only_frame():
+    # Read-only frames (like the ones from `stbt.get_frame`) cache their
+    # grayscale version; check that the mask doesn't modify the cached image.
+    frame = stbt.Frame(stbt.load_image("videotestsrc-full-frame.png"))
+    frame.flags.writeable = False
+    assert stbt.is_screen_black(frame, "videotestsrc-mask-non-black.png")
+    assert not stbt.is_screen_black(frame)
+
+
+class _FakeDisplay(object):
+    """Delivers a new frame every 0.1 seconds (of mock time, see `mock_time`),
+    and buffers the most recent `depth` frames (like `_stbt.core.Display`).
+    """
+    def __init__(self, depth=1):
+        self.depth = depth
+
+    def get_frame(self, timeout_secs=10, since=None):  # pylint:disable=unused-argument
+        def sequence_number(t):
+            return int(round((t - 1497000000) * 10))
+
+        n = sequence_number(time.time())
+        if since is not None:
+            if n <= sequence_number(since):
+                time.sleep(0.1)
+                n += 1
+            else:
+                n = max(sequence_number(since) + 1, n - self.depth + 1)
+        frame = stbt.Frame(numpy.zeros((2, 2, 3), dtype=numpy.uint8),
+                           time=1497000000 + n / 10.)
+        frame._sequence_number = n  # pylint:disable=protected-access
+        return frame
+
+
+def _frame_sequence_numbers(frames, count, processing_secs):
+    out = []
+    for frame in frames:
+        out.append(frame._sequence_number)  # pylint:disable=protected-access
+        if len(out) == count:
+            return out
+        time.sleep(processing_secs)
+
+
+def test_that_frames_skips_frames_that_arrive_while_processing(mock_time):
+    from _stbt.core import DeviceUnderTest
+    dut = DeviceUnderTest(display=_FakeDisplay(), _time=time)
+    assert _frame_sequence_numbers(dut.frames(), 4, 0) == [0, 1, 2, 3]
+    assert _frame_sequence_numbers(dut.frames(), 4, 0.3) == [3, 6, 9, 12]
+    assert dut.frames_dropped == 6
+
+
+def test_that_frames_yields_every_buffered_frame(mock_time):
+    from _stbt.core import DeviceUnderTest
+    dut = DeviceUnderTest(display=_FakeDisplay(depth=4), _time=time)
+    assert _frame_sequence_numbers(dut.frames(), 4, 0.2) == [0, 1, 2, 3]
+    assert dut.frames_dropped == 0
+    # Falls behind by 1 frame per iteration until the buffer is full, then
+    # the oldest frames fall out of the buffer:
+    assert _frame_sequence_numbers(dut.frames(), 6, 0.2) == [
+        6, 7, 8, 9, 11, 13]
+    assert dut.frames_dropped == 2
+
+
+def test_frame_buffer():
+    from _stbt.core import _FrameBuffer
+
+    def frame(t, nbytes=10):
+        return stbt.Frame(numpy.zeros((nbytes, 1), dtype=numpy.uint8), time=t)
+
+    b = _FrameBuffer(depth=3)
+    assert b.latest(0) is None
+    assert b.next_after(0) is None
+    for t in range(1, 6):
+        b.append(frame(t))
+    assert len(b) == 3
+    assert b.latest(0).time == 5
+    assert b.latest(5) is None
+    assert b.next_after(0).time == 3
+    assert b.next_after(3.5).time == 4
+    assert b.next_after(5) is None
+
+    b = _FrameBuffer(depth=10, max_bytes=25)
+    for t in range(1, 6):
+        b.append(frame(t))
+    assert len(b) == 2
+    assert b.next_after(0).time == 4
+
+    # Always keeps the most recent frame, even if it's bigger than max_bytes:
+    b.append(frame(6, nbytes=100))
+    assert len(b) == 1
+    assert b.latest(0).time == 6
+
+
+def test_frames_with_max_analysis_fps(mock_time):
+    from _stbt.core import DeviceUnderTest
+    from tests.test_ocr import temporary_config
+    dut = DeviceUnderTest(display=_FakeDisplay(), _time=time)
+    with temporary_config({"global.max_analysis_fps": "2"}):
+        assert _frame_sequence_numbers(dut.frames(), 3, 0) == [0, 5, 10]
+        assert _frame_sequence_numbers(dut.frames(), 3, 0.3) == [10, 15, 20]
+        assert _frame_sequence_numbers(dut.frames(), 3, 0.7) == [20, 27, 34]
+
+
+@pytest.mark.parametrize("name", ["videoconvert_threads", "decoder_threads"])
+def test_that_negative_thread_counts_are_rejected(name):
+    from _stbt.config import ConfigurationError
+    from _stbt.core import new_device_under_test_from_config
+    from tests.test_ocr import temporary_config
+    with temporary_config({"global." + name: "-1"}):
+        with pytest.raises(ConfigurationError) as excinfo:
+            new_device_under_test_from_config()
+        assert name in str(excinfo.value)
+
+
+def test_that_decoder_threads_are_set_in_nested_bins():
+    from gi.repository import Gst
+    from _stbt.core import Display
+
+    display = Display.__new__(Display)
+    display.decoder_threads = 3
+    decodebin = Gst.Bin.new("decodebin")
+    decodebin.connect("element-added", display.on_decodebin_element_added)
+
+    # Like decodebin3's parsebin: A child bin that already has elements in it
+    # when it's added, and gets more elements later.
+    parsebin = Gst.Bin.new("parsebin")
+    existing = Gst.ElementFactory.make("videoconvert", None)
+    if existing.find_property("n-threads") is None:
+        pytest.skip("videoconvert n-threads requires GStreamer 1.12")
+    parsebin.add(existing)
+    decodebin.add(parsebin)
+    added_later = Gst.ElementFactory.make("videoconvert", None)
+    parsebin.add(added_later)
+
+    assert existing.get_property("n-threads") == 3
+    assert added_later.get_property("n-threads") == 3
+
+
+def test_that_overlay_images_match_drawing_on_the_frame():
+    from _stbt.core import _Annotation, _draw_overlay_images, _TextLabel
+
+    numpy.random.seed(1)
+    frame = numpy.random.randint(0, 256, (720, 1280, 3)).astype(numpy.uint8)
+    drawables = [
+        _TextLabel("12:34:56.78", (10, 30), (255, 255, 255)),
+        _TextLabel("Typing gjpqy", (10, 60), (127, 127, 127)),
+        _TextLabel("Short", (10, 90), (255, 255, 255)),
+        _Annotation(0, stbt.Region(400, 300, 200, 100), "match", (32, 0, 255)),
+        _Annotation(0, stbt.Region(500, 350, 200, 100), "", (32, 255, 255)),
+        _Annotation(0, stbt.Region(1200, -20, 200, 100), "off-screen",
+                    (0, 0, 255)),
+        _Annotation(0, None, "no region", (0, 0, 255)),
+    ]
+    expected = frame.copy()
+    for x in drawables:
+        x.draw(expected)
+
+    actual = frame.copy()
+    overlay_pixels = 0
+    for x, y, img in _draw_overlay_images(frame, drawables):
+        actual[y:y + img.shape[0], x:x + img.shape[1]] = img
+        overlay_pixels += img.shape[0] * img.shape[1]
+
+    assert numpy.array_equal(actual, expected)
+    assert overlay_pixels < 0.1 * frame.shape[0] * frame.shape[1]
+
+
 class C(object):
     """A class with a single property, used by the tests."""
     def __init__(self, prop):
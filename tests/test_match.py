@@ -1,4 +1,5 @@
 import random
+import time
 import timeit
 
 import cv2
@@ -9,6 +10,7 @@ import stbt
 from _stbt import cv2_compat
 from _stbt.match import _merge_regions
 from tests.test_core import _find_file
+from tests.test_ocr import temporary_config
 
 
 requires_opencv_3 = pytest.mark.skipif(cv2_compat.version < [3, 0, 0],
@@ -256,6 +258,304 @@ def test_match_all_with_an_image_that_matches_everywhere(match_method):
     assert matches == expected_matches
 
 
+def test_find_candidate_positions_order():
+    from _stbt.match import _find_candidate_positions
+    heatmap = numpy.array([[0.5, 0.1, 0.9],
+                           [0.1, 0.0, 0.3]], dtype=numpy.float32)
+    assert [(x, y) for x, y, _ in _find_candidate_positions(heatmap, 1, 0.6)] \
+        == [(1, 1), (1, 0), (0, 1), (2, 1)]
+
+
+@pytest.mark.parametrize("reference,frame", [
+    ("videotestsrc-redblue.png", "videotestsrc-full-frame.png"),
+    ("button.png", "buttons.png"),
+    ("red-black.png", "videotestsrc-full-frame.png"),
+])
+def test_sqdiff_lower_bound(reference, frame):
+    from _stbt.match import _ImagePyramid, _sqdiff_lower_bound
+    reference = stbt.load_image(reference)
+    frame = stbt.load_image(frame)
+    heatmap = cv2.matchTemplate(frame, reference, cv2.TM_SQDIFF)
+    bound = _sqdiff_lower_bound(_ImagePyramid(frame).integral(0), reference)
+    assert bound.shape == heatmap.shape
+    # Allow for rounding errors in matchTemplate:
+    assert numpy.all(bound <= heatmap + reference.size * (255 ** 2) * 1e-5)
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.SQDIFF_NORMED,
+])
+def test_that_match_many_gives_same_results_as_match(match_method):
+    frame = stbt.load_image("buttons.png")
+    images = ["button.png", "button-transparent.png", "black.png",
+              "red-black.png", black(30, 30)]
+    if match_method != stbt.MatchMethod.SQDIFF:
+        images.remove("button-transparent.png")
+    for region in [stbt.Region.ALL,
+                   stbt.Region(x=160, y=60, right=340, bottom=190)]:
+        results = stbt.match_many(
+            images, frame=frame, region=region,
+            match_parameters=mp(match_method=match_method))
+        assert len(results) == len(images)
+        for image, result in zip(images, results):
+            expected = stbt.match(
+                image, frame=frame, region=region,
+                match_parameters=mp(match_method=match_method))
+            assert result.match == expected.match
+            assert result.region == expected.region
+            assert result.first_pass_result == expected.first_pass_result
+        assert results[0]  # button.png
+        assert not any(results[-3:])  # black.png, red-black.png, black(30, 30)
+
+
+def test_that_frame_pyramids_are_cached_on_read_only_frames():
+    from _stbt.imgutils import _frame_cache
+    from _stbt.match import _frame_pyramids
+
+    region = stbt.Region(x=160, y=60, right=340, bottom=190)
+    frame = stbt.Frame(stbt.load_image("buttons.png"))
+    assert _frame_cache(frame) is None
+    assert stbt.match("button.png", frame=frame)
+    frame.flags.writeable = False
+    expected = stbt.match("button.png", frame=frame, region=region)
+
+    pyramids = _frame_pyramids(frame)
+    assert pyramids.get(region) is not None
+    assert _frame_cache(frame[10:20, 10:20]) == {}
+
+    result = stbt.match("button.png", frame=frame, region=region)
+    assert result.region == expected.region
+    assert result.first_pass_result == expected.first_pass_result
+    assert _frame_pyramids(frame) is pyramids
+
+
+@pytest.mark.parametrize("image,frame", [
+    ("repeating-pattern.png", "repeating-pattern-full-frame.png"),
+    ("button.png", "buttons.png"),
+])
+def test_that_match_all_with_threads_gives_same_results(image, frame):
+    def results():
+        return [(m.region, m.first_pass_result)
+                for m in stbt.match_all(image, frame=frame)]
+
+    frame = stbt.load_image(frame)
+    expected = results()
+    with temporary_config({"match.threads": "4"}):
+        assert expected == results()
+
+
+def test_that_match_all_with_threads_works_after_fork():
+    import multiprocessing
+
+    def results():
+        return [(m.region, m.first_pass_result)
+                for m in stbt.match_all("button.png", frame=frame)]
+
+    def child(queue):
+        queue.put(results() == expected)
+
+    frame = stbt.load_image("buttons.png")
+    with temporary_config({"match.threads": "4"}):
+        expected = results()  # Creates the thread pool in this process
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=child, args=(queue,))
+        p.start()
+        try:
+            assert queue.get(timeout=10)
+        finally:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+        assert p.exitcode == 0
+
+
+def test_match_with_negative_strides():
+    # `sqdiff_heatmap` (used for small templates) doesn't support frames with
+    # negative strides, so we fall back to `cv2.matchTemplate`.
+    flipped = stbt.load_image("buttons.png")[::-1]
+    frame = numpy.ascontiguousarray(flipped)
+    template = numpy.ascontiguousarray(frame[190:198, 220:232])
+    expected = stbt.match(template, frame=frame)
+    result = stbt.match(template, frame=flipped)
+    assert result.region == expected.region
+    assert result.first_pass_result == pytest.approx(
+        expected.first_pass_result)
+
+
+def test_that_wait_for_match_searches_near_previous_match_first():
+    from _stbt.imgutils import _load_image
+    from _stbt.match import _hint_key, _last_match_regions, _match
+
+    def frames():
+        while True:
+            f = stbt.Frame(stbt.load_image("buttons.png"), time=time.time())
+            f.flags.writeable = False
+            yield f
+
+    expected = stbt.match("button.png", frame=next(frames()))
+    key = _hint_key(_load_image("button.png"), mp(), stbt.Region.ALL)
+    _last_match_regions.clear()
+    assert stbt.wait_for_match("button.png", frames=frames()).region == \
+        expected.region
+    assert _last_match_regions.get(key) == expected.region
+
+    # Hint in the wrong place: Falls back to searching the whole frame
+    _last_match_regions[key] = overlapped_button
+    assert stbt.wait_for_match("button.png", frames=frames()).region == \
+        expected.region
+    assert _last_match_regions.get(key) == expected.region
+
+    # Hint that is too small for the reference image: Falls back to searching
+    # the whole frame instead of raising ValueError
+    _last_match_regions[key] = stbt.Region(
+        x=expected.region.x, y=expected.region.y, width=1, height=1)
+    assert stbt.wait_for_match("button.png", frames=frames()).region == \
+        expected.region
+    assert _match("button.png", next(frames()), None, stbt.Region.ALL,
+                  hint=stbt.Region(0, 0, width=1, height=1)).region == \
+        expected.region
+
+    # Different scales (or a newer version of the file) don't use the same
+    # hint
+    scaled = mp(scales=(0.5, 1.0))
+    assert _hint_key(_load_image("button.png"), scaled, stbt.Region.ALL) \
+        != key
+    assert stbt.wait_for_match("button.png", match_parameters=scaled,
+                               frames=frames()).region == expected.region
+
+    assert _match("button.png", next(frames()), None, stbt.Region.ALL,
+                  hint=expected.region).region == expected.region
+
+
+@pytest.mark.parametrize("match_method", [
+    stbt.MatchMethod.SQDIFF,
+    stbt.MatchMethod.SQDIFF_NORMED,
+    stbt.MatchMethod.CCOEFF_NORMED,
+])
+@pytest.mark.parametrize("image,frame", [
+    ("button.png", "buttons.png"),
+    ("button.png", "black-full-frame.png"),
+    ("red-black.png", "videotestsrc-full-frame.png"),
+    ("videotestsrc-redblue-flipped.png", "videotestsrc-full-frame.png"),
+])
+def test_probe_match(match_method, image, frame):
+    from _stbt.match import _match, _probe_match
+    from collections import Counter
+
+    frame = stbt.load_image(frame)
+    expected = stbt.match(image, frame=frame,
+                          match_parameters=mp(match_method=match_method))
+    result = _probe_match(image, frame, mp(match_method=match_method),
+                          stbt.Region.ALL)
+    if expected:
+        assert result is None
+    elif result is not None:
+        assert not result
+        if match_method != stbt.MatchMethod.SQDIFF:
+            assert result.region == expected.region
+            assert result.first_pass_result == expected.first_pass_result
+
+    stats = Counter()
+    assert bool(_match(image, frame, mp(match_method=match_method),
+                       stbt.Region.ALL, probe=True, stats=stats)) == \
+        bool(expected)
+    assert sum(stats.values()) == 1
+    if result is not None:
+        assert stats["rejected by first pass at level %d"
+                     % result._first_pass_level] == 1  # pylint:disable=protected-access
+
+
+def test_that_full_search_reuses_probe_results(monkeypatch):
+    from collections import Counter
+    import _stbt.match
+
+    calls = Counter()
+    match_template = _stbt.match._match_template  # pylint:disable=protected-access
+
+    def counting_match_template(image, template, mask, method, roi_mask,
+                                level, imwrite):
+        calls[level] += 1
+        return match_template(image, template, mask, method, roi_mask, level,
+                              imwrite)
+
+    monkeypatch.setattr(_stbt.match, "_match_template",
+                        counting_match_template)
+
+    frame = stbt.Frame(stbt.load_image("buttons.png"))
+    frame.flags.writeable = False
+    expected = stbt.match("button.png", frame=frame.copy())
+    calls.clear()
+
+    stats = Counter()
+    result = _stbt.match._match(  # pylint:disable=protected-access
+        "button.png", frame, None, stbt.Region.ALL, probe=True, stats=stats)
+    assert result.region == expected.region
+    assert result.first_pass_result == expected.first_pass_result
+    assert stats == Counter(["matched"])
+    assert calls == Counter([0, 1, 2])  # The top level is only searched once
+
+    # A non-matching frame: The probe rejects it at the top level, and the
+    # stats record the level where it was rejected:
+    stats = Counter()
+    frame = stbt.Frame(black())
+    frame.flags.writeable = False
+    assert not _stbt.match._match(  # pylint:disable=protected-access
+        "button.png", frame, None, stbt.Region.ALL, probe=True, stats=stats)
+    assert stats == Counter(["rejected by first pass at level 2"])
+
+
+def test_match_all_with_scales():
+    frame = stbt.load_image("buttons.png")
+    expected = sorted(m.region for m in stbt.match_all("button.png", frame))
+
+    frame = cv2.resize(frame, None, fx=2, fy=2,
+                       interpolation=cv2.INTER_NEAREST)
+    assert not stbt.match("button.png", frame)
+    matches = sorted(m.region for m in stbt.match_all(
+        "button.png", frame, match_parameters=mp(scales=(1.0, 2.0))))
+    assert matches == [
+        stbt.Region(r.x * 2, r.y * 2, r.width * 2, r.height * 2)
+        for r in expected]
+
+    with pytest.raises(ValueError):
+        mp(scales=(1.0, 0))
+
+
+def test_that_scaled_reference_images_are_cached():
+    from _stbt.match import _Template
+
+    template = _Template(stbt.load_image("button-transparent.png"))
+    assert template.scaled(1.0) is template
+    half = template.scaled(0.5)
+    assert template.scaled(0.5) is half
+    assert half.image.shape == (22, 68, 4)
+    assert numpy.array_equal(half.pyramid.image,
+                             template.pyramid.levels(2)[1])
+    assert template.scaled(1.5).image.shape == (66, 203, 4)
+
+
+def test_that_reference_images_are_cached():
+    from _stbt.imgutils import _image_cache
+
+    frame = stbt.load_image("buttons.png")
+    expected = stbt.match("button-transparent.png", frame=frame)
+    hits, misses = _image_cache.hits, _image_cache.misses
+    result = stbt.match("button-transparent.png", frame=frame)
+    assert (_image_cache.hits, _image_cache.misses) == (hits + 1, misses)
+    assert result.region == expected.region
+    assert result.first_pass_result == expected.first_pass_result
+
+
+def test_that_match_doesnt_modify_reference_image():
+    reference = stbt.load_image("button-transparent.png")
+    alpha = reference[:, :, 3]
+    alpha[alpha == 0] = 100
+    original = reference.copy()
+    assert stbt.match(reference, frame=stbt.load_image("buttons.png"))
+    assert numpy.array_equal(reference, original)
+
+
 def test_that_sqdiff_matches_black_images():
     black_reference = black(10, 10)
     almost_black_reference = black(10, 10, value=1)
@@ -1,6 +1,8 @@
 import time
+import weakref
 from contextlib import contextmanager
 
+import cv2
 import numpy
 import pytest
 
@@ -57,6 +59,72 @@ def test_wait_for_motion_half_motion_int():
         stbt.wait_for_motion(consecutive_frames=2, frames=fake_frames())
 
 
+class _FakeGrayStream(object):
+    """Like `_stbt.core.Display` with ``gray_stream_scale=0.5``."""
+    def __init__(self):
+        self.gray_frames = {}
+
+    def frame(self, image, t, dropped=False):
+        frame = stbt.Frame(image, time=t)
+        frame.flags.writeable = False
+        frame._gray_stream = weakref.ref(self)  # pylint:disable=protected-access
+        if not dropped:
+            gray = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
+                              (image.shape[1] // 2, image.shape[0] // 2),
+                              interpolation=cv2.INTER_AREA)
+            gray.flags.writeable = False
+            self.gray_frames[t] = gray
+        return frame
+
+    def get_gray_frame(self, t):
+        return self.gray_frames.get(t)
+
+
+def test_detect_motion_with_gray_stream():
+    stream = _FakeGrayStream()
+    a = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    b = a.copy()
+    b[100:120, 200:260] = 255
+
+    def frames():
+        yield stream.frame(a, 0)
+        yield stream.frame(a, 1)
+        yield stream.frame(b, 2)
+        # Frames that the gray stream dropped are scaled down from the
+        # full-resolution frame:
+        yield stream.frame(b, 3, dropped=True)
+        yield stream.frame(a, 4, dropped=True)
+
+    region = stbt.Region(101, 51, right=1001, bottom=601)
+    results = list(stbt.detect_motion(frames=frames(), region=region))
+    assert [r.motion for r in results] == [False, True, False, True]
+    for r in (results[1], results[3]):
+        assert r.region.contains(
+            stbt.Region(200, 100, right=260, bottom=120).erode(2))
+        assert stbt.Region(200, 100, right=260, bottom=120).dilate(2) \
+            .contains(r.region)
+
+    mask = numpy.ones((region.height, region.width), dtype=numpy.uint8) * 255
+    mask[40:80, 90:170] = 0
+    results = list(stbt.detect_motion(frames=frames(), region=region,
+                                      mask=mask))
+    assert [r.motion for r in results] == [False, False, False, False]
+
+
+def test_is_screen_black_with_gray_stream():
+    stream = _FakeGrayStream()
+    image = numpy.zeros((720, 1280, 3), dtype=numpy.uint8)
+    image[100:104, 200:204] = 255
+    assert not stbt.is_screen_black(stream.frame(image, 0))
+    image[100:104, 200:204] = 0
+    frame = stream.frame(image, 1)
+    assert stbt.is_screen_black(frame)
+    # `is_screen_black` uses the gray stream rather than the full-resolution
+    # frame:
+    stream.gray_frames[1] = numpy.ones((360, 640), dtype=numpy.uint8) * 255
+    assert not stbt.is_screen_black(frame)
+
+
 def fake_frames():
     a = numpy.zeros((2, 2, 3), dtype=numpy.uint8)
     a.flags.writeable = False
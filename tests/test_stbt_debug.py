@@ -320,6 +320,24 @@ def test_match_debug():
         assert_expected("stbt-debug-expected-output/match")
 
 
+def test_match_debug_with_scales():
+    with scoped_curdir(), scoped_debug_level(2):
+        # Doesn't match at the first scale, so it searches both scales:
+        matches = list(stbt.match_all(
+            "button.png", frame=stbt.load_image("buttons.png"),
+            match_parameters=mp(scales=(0.5, 1.0))))
+        print matches
+        assert len(matches) == 6
+
+        outdir = os.path.join("stbt-debug", os.listdir("stbt-debug")[0])
+        files = set(os.listdir(outdir))
+        for name in ["index.html", "source_with_matches.png",
+                     "level0-source_with_match.png",
+                     "scale1-level0-source_with_match.png",
+                     "scale1-match5-heatmap.png"]:
+            assert name in files
+
+
 def test_motion_debug():
     # So that the output directory name doesn't depend on how many tests
     # were run before this one.